@@ -1 +1,2 @@
-from country_window_processor import *
\ No newline at end of file
+from country_window_processor import *
+from raster_archive import *
\ No newline at end of file
@@ -4,7 +4,12 @@ surrounding the country of interest."""
 
 import gdal, os
 import numpy as np
-from time import sleep
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+try:
+	from collections.abc import Mapping
+except ImportError:
+	from collections import Mapping
 
 """Set up filesystem paths for data processing"""
 BASE_PATH = '/Users/samuelalbanie/aims_course/project_one/Geography_Data/insolation'
@@ -22,46 +27,111 @@ BENIN_BBOX = {
 	'height': 6.4, 
 }
 
+"""Provide the part of the filename which holds the date for each
+of the supported raster formats."""
+DATE_KEYS = {
+	'.rst': slice(None, 7), # 'YYYY_MM_NAME.rst'
+	'.tif': slice(-8, -4), # 'NAME_YYYY.tif'
+	'.bil': slice(5, 7), # 'NAMEYYag.bil'
+}
+
+"""Provide the default number of files read concurrently."""
+NUM_THREADS = 8
+
+"""Provide the default number of files a lazy dataset keeps open."""
+MAX_HANDLES = 32
+
+"""Provide the largest ratio between the area of a shared window and
+the summed areas of the countries read through it."""
+MAX_COVER_OVERHEAD = 1.5
+
+def date_key(fname):
+	"""returns the date key of a raster filename, according to 
+	the naming convention of its format in DATE_KEYS."""
+	return fname[DATE_KEYS[fname[-4:]]]
+
+def raster_fnames(path, extension):
+	"""returns a sorted list of the filenames in the directory 
+	at path with the given extension."""
+	fnames = next(os.walk(path))[2]
+	return sorted([fname for fname in fnames if fname[-4:] == extension])
+
+def import_files(path, extension):
+	"""Returns a dictionary using dates as keys with gdal object 
+	values for every file in path with the given extension."""
+	dataset = {}
+	for fname in raster_fnames(path, extension):
+		dataset[date_key(fname)] = gdal.Open(path + fname)
+	return dataset
+
 def import_rst_files(path=IMPORT_PATH):
 	"""Assumes filenames take the form 'YYYY_MM_NAME.rst' 
 	where NAME can be any value. Returns a dictionary 
 	using dates as keys with gdal object values."""
-	dataset = {}
-	fnames = next(os.walk(path))[2]
-	fnames = [fname for fname in fnames if fname[-4:] == ".rst"]
-	for fname in fnames:
-		dataset[fname[:7]] = gdal.Open(path + fname)
-		sleep(0.1)
-	return dataset
+	return import_files(path, '.rst')
 
 def import_tiff_files(path=IMPORT_PATH):
 	"""Assumes filenames take the form 'NAME_YYYY.tif' 
 	where NAME can be any value. Returns a dictionary 
 	using dates as keys with gdal object values."""
-	dataset = {}
-	fnames = next(os.walk(path))[2]
-	fnames = [fname for fname in fnames if fname[-4:] == ".tif"]
-	for fname in fnames:
-		dataset[fname[-8:-4]] = gdal.Open(path + fname)
-		sleep(0.1)
-	return dataset
+	return import_files(path, '.tif')
 
 def import_bil_files(path=IMPORT_PATH):
 	"""Assumes filenames take the form 'NAMEYYag.bil' 
 	where NAME can be any value. Returns a dictionary 
 	using dates as keys with gdal object values."""
-	dataset = {}
-	fnames = next(os.walk(path))[2]
-	fnames = [fname for fname in fnames if fname[-4:] == ".bil"]
-	for fname in fnames:
-		dataset[fname[5:7]] = gdal.Open(path + fname)
-		sleep(0.1)
-	return dataset
+	return import_files(path, '.bil')
+
+class LazyRasterDataset(Mapping):
+	"""A dictionary-like dataset using dates as keys with gdal 
+	object values, as returned by import_rst_files, which only 
+	opens a file when its key is first accessed. At most 
+	max_handles files are kept open; the least recently used 
+	handle is released (closing the file, unless the caller 
+	still holds a reference to it) when another is needed."""
+
+	def __init__(self, path, extension, max_handles=MAX_HANDLES):
+		self.path = path
+		self.max_handles = max_handles
+		self.fnames = OrderedDict()
+		for fname in raster_fnames(path, extension):
+			self.fnames[date_key(fname)] = fname
+		self._handles = OrderedDict()
+
+	def __getitem__(self, key):
+		if key in self._handles:
+			gdal_instance = self._handles.pop(key)
+		else:
+			gdal_instance = gdal.Open(self.path + self.fnames[key])
+			while self._handles and len(self._handles) >= self.max_handles:
+				self._handles.popitem(last=False)
+		self._handles[key] = gdal_instance
+		return gdal_instance
+
+	def __iter__(self):
+		return iter(self.fnames)
+
+	def __len__(self):
+		return len(self.fnames)
+
+	def num_open(self):
+		"""returns the number of files currently held open."""
+		return len(self._handles)
+
+	def close(self):
+		"""releases every open handle."""
+		self._handles.clear()
+
+def lazy_import_files(path=IMPORT_PATH, extension='.rst', max_handles=MAX_HANDLES):
+	"""returns a LazyRasterDataset over the files in path with 
+	the given extension, which opens files on first access."""
+	return LazyRasterDataset(path, extension, max_handles)
 
 def get_geotransform(dataset):
 	"""returns a tuple containing the geo matrix for
-	the raster data."""
-	gdal_instance = list(dataset.values())[0]
+	the raster data. Only the first file of the dataset 
+	is accessed."""
+	gdal_instance = next(iter(dataset.values()))
 	geotransform = gdal_instance.GetGeoTransform()
 	return geotransform
 
@@ -78,11 +148,134 @@ def pixel_coordinates(geotransform, deg_bbox=BENIN_BBOX):
     pixel_bbox['width'], pixel_bbox['height'] = width, height
     return pixel_bbox
 
-def export_numpy(pixel_data, path):
+def read_window(gdal_instance, pixel_bbox, band=1):
+	"""returns a numpy array of the pixel values inside pixel_bbox,
+	reading only that window from the raster band rather than 
+	the whole band."""
+	raster_band = gdal_instance.GetRasterBand(band)
+	return raster_band.ReadAsArray(pixel_bbox['x'], pixel_bbox['y'],
+		pixel_bbox['width'], pixel_bbox['height'])
+
+def extract_windows(dataset, deg_bbox=BENIN_BBOX, band=1):
+	"""returns a dictionary using dates as keys with numpy arrays 
+	of the pixel values inside deg_bbox as values (in the form 
+	expected by export_numpy). Each file is read with a windowed
+	read of the bounding box only."""
+	geotransform = get_geotransform(dataset)
+	pixel_bbox = pixel_coordinates(geotransform, deg_bbox)
+	pixel_data = {}
+	for key in dataset.keys():
+		pixel_data[key] = read_window(dataset[key], pixel_bbox, band)
+	return pixel_data
+
+def covering_bbox(pixel_bboxes):
+	"""returns the smallest pixel bbox which contains every 
+	pixel bbox in the given list."""
+	left = min(bbox['x'] for bbox in pixel_bboxes)
+	top = min(bbox['y'] for bbox in pixel_bboxes)
+	right = max(bbox['x'] + bbox['width'] for bbox in pixel_bboxes)
+	bottom = max(bbox['y'] + bbox['height'] for bbox in pixel_bboxes)
+	pixel_bbox = {}
+	pixel_bbox['x'], pixel_bbox['y'] = left, top
+	pixel_bbox['width'], pixel_bbox['height'] = right - left, bottom - top
+	return pixel_bbox
+
+def slice_window(window, cover_bbox, pixel_bbox):
+	"""returns a copy of the part of window (read over cover_bbox) 
+	which lies inside pixel_bbox."""
+	y = pixel_bbox['y'] - cover_bbox['y']
+	x = pixel_bbox['x'] - cover_bbox['x']
+	return window[y:y + pixel_bbox['height'], x:x + pixel_bbox['width']].copy()
+
+def bbox_area(pixel_bbox):
+	"""returns the number of pixels in a pixel bbox."""
+	return pixel_bbox['width'] * pixel_bbox['height']
+
+def group_bboxes(pixel_bboxes, max_overhead=MAX_COVER_OVERHEAD):
+	"""returns a list of lists of the keys of pixel_bboxes (a dict
+	of pixel bboxes), grouping bboxes which are cheaper to read 
+	through one covering window. Groups are merged greedily, most
+	compact first, while the covering window of the merged group 
+	holds at most max_overhead times the summed area of its bboxes."""
+	groups = [[key] for key in sorted(pixel_bboxes.keys())]
+	while len(groups) > 1:
+		best = None
+		for i in range(len(groups)):
+			for j in range(i + 1, len(groups)):
+				keys = groups[i] + groups[j]
+				cover = covering_bbox([pixel_bboxes[key] for key in keys])
+				area = sum(bbox_area(pixel_bboxes[key]) for key in keys)
+				overhead = bbox_area(cover) / float(max(area, 1))
+				if overhead <= max_overhead and (best is None or overhead < best[0]):
+					best = (overhead, i, j)
+		if best is None:
+			break
+		overhead, i, j = best
+		groups[i] = groups[i] + groups.pop(j)
+	return groups
+
+def extract_country_windows(dataset, deg_bboxes, band=1,
+		max_overhead=MAX_COVER_OVERHEAD):
+	"""returns a dictionary using country names as keys, whose 
+	values are dictionaries of the form returned by 
+	extract_windows. deg_bboxes maps each country name to a 
+	bounding box in lat/lon. Each file is opened once; countries 
+	close enough together (see group_bboxes) are read through a 
+	single covering window and sliced out of it, and the others 
+	are read with one window each."""
+	geotransform = get_geotransform(dataset)
+	pixel_bboxes = {}
+	for country in deg_bboxes.keys():
+		pixel_bboxes[country] = pixel_coordinates(geotransform, deg_bboxes[country])
+	groups = group_bboxes(pixel_bboxes, max_overhead)
+	cover_bboxes = [covering_bbox([pixel_bboxes[country] for country in group])
+		for group in groups]
+	country_data = dict((country, {}) for country in pixel_bboxes.keys())
+	for key in dataset.keys():
+		gdal_instance = dataset[key]
+		for group, cover_bbox in zip(groups, cover_bboxes):
+			window = read_window(gdal_instance, cover_bbox, band)
+			for country in group:
+				country_data[country][key] = slice_window(window, cover_bbox,
+					pixel_bboxes[country])
+	return country_data
+
+def read_file_window(args):
+	"""returns the window of a single raster file, given a tuple
+	of (filename, pixel_bbox, band). The file is closed as soon 
+	as the window has been read."""
+	fname, pixel_bbox, band = args
+	gdal_instance = gdal.Open(fname)
+	window = read_window(gdal_instance, pixel_bbox, band)
+	gdal_instance = None
+	return window
+
+def import_windows(path=IMPORT_PATH, extension='.rst', deg_bbox=BENIN_BBOX,
+		num_threads=NUM_THREADS, band=1):
+	"""returns a dictionary using dates as keys with numpy arrays 
+	of the pixel values inside deg_bbox as values, for every file 
+	in path with the given extension. Files are opened and their 
+	windows read on a pool of num_threads threads, so at most 
+	num_threads files are open at once."""
+	fnames = raster_fnames(path, extension)
+	geotransform = gdal.Open(path + fnames[0]).GetGeoTransform()
+	pixel_bbox = pixel_coordinates(geotransform, deg_bbox)
+	args = [(path + fname, pixel_bbox, band) for fname in fnames]
+	pool = ThreadPool(num_threads)
+	try:
+		windows = pool.map(read_file_window, args)
+	finally:
+		pool.close()
+		pool.join()
+	keys = [date_key(fname) for fname in fnames]
+	return dict(zip(keys, windows))
+
+def export_numpy(pixel_data, path, suffix='_benin'):
 	"""Saves processed data as numpy files in the given 
-	directory"""
+	directory, appending suffix (e.g. the country name) to
+	each date key."""
 	for key in pixel_data.keys():
-		np.save(path + key + '_benin', pixel_data[key])
+		np.save(path + key + suffix, pixel_data[key])
 
 
 	
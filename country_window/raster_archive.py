@@ -0,0 +1,142 @@
+"""raster_archive provides methods to convert a dataset of raster files
+into a chunked, compressed (time, y, x) store on local disk, and to query
+any lat/lon bounding box and date range from it by reading only the
+chunks which intersect the query."""
+
+import os, json
+import numpy as np
+from country_window_processor import get_geotransform, pixel_coordinates
+from country_window_processor import read_window
+
+"""Provide the default spatial shape (height, width) of each chunk."""
+TILE_SHAPE = (256, 256)
+"""Provide the default number of dates stored in each chunk."""
+TIME_CHUNK = 12
+"""Name the index file and the directory of chunk files."""
+INDEX_FNAME = 'index.json'
+CHUNK_DIR = 'chunks'
+"""Mark queried pixels which lie outside the archived region."""
+MISSING = -999
+
+def raster_bbox(gdal_instance):
+	"""returns a pixel bbox covering the whole raster."""
+	pixel_bbox = {}
+	pixel_bbox['x'], pixel_bbox['y'] = 0, 0
+	pixel_bbox['width'] = gdal_instance.RasterXSize
+	pixel_bbox['height'] = gdal_instance.RasterYSize
+	return pixel_bbox
+
+def chunk_fname(t, y, x):
+	"""returns the filename of the chunk starting at the given
+	time index and pixel offsets."""
+	return os.path.join(CHUNK_DIR, 't%d_y%d_x%d.npz' % (t, y, x))
+
+def build_archive(dataset, path, deg_bbox=None, tile_shape=TILE_SHAPE,
+		time_chunk=TIME_CHUNK, band=1):
+	"""Writes the rasters in dataset (a dict using dates as keys with
+	gdal object values) to a chunked archive in the directory at path
+	and returns its index. The archive covers deg_bbox, or the whole
+	raster if no bbox is given. Each chunk holds up to time_chunk dates
+	of one tile_shape tile and is stored as a compressed .npz file; the
+	index records the geotransform of the source rasters, the pixel
+	bbox of the archived region, the dates and the extent of every
+	chunk. Rasters are read one band of tile rows at a time, so memory
+	is bounded by time_chunk x tile height x archive width."""
+	dates = sorted(dataset.keys())
+	geotransform = get_geotransform(dataset)
+	if deg_bbox is None:
+		region = raster_bbox(dataset[dates[0]])
+	else:
+		region = pixel_coordinates(geotransform, deg_bbox)
+	if not os.path.isdir(os.path.join(path, CHUNK_DIR)):
+		os.makedirs(os.path.join(path, CHUNK_DIR))
+	chunks = []
+	dtype = None
+	for t in range(0, len(dates), time_chunk):
+		chunk_dates = dates[t:t + time_chunk]
+		for y in range(0, region['height'], tile_shape[0]):
+			row_bbox = {
+				'x': region['x'],
+				'y': region['y'] + y,
+				'width': region['width'],
+				'height': min(tile_shape[0], region['height'] - y),
+			}
+			block = np.array([read_window(dataset[date], row_bbox, band)
+				for date in chunk_dates])
+			dtype = block.dtype.str
+			for x in range(0, region['width'], tile_shape[1]):
+				tile = block[:, :, x:x + tile_shape[1]]
+				fname = chunk_fname(t, y, x)
+				np.savez_compressed(os.path.join(path, fname), data=tile)
+				chunks.append({
+					't': t, 'y': y, 'x': x, 'length': tile.shape[0],
+					'height': tile.shape[1], 'width': tile.shape[2],
+					'fname': fname,
+				})
+	index = {
+		'geotransform': list(geotransform),
+		'region': region,
+		'shape': [len(dates), region['height'], region['width']],
+		'dates': dates,
+		'dtype': dtype,
+		'chunks': chunks,
+	}
+	with open(os.path.join(path, INDEX_FNAME), 'w') as f:
+		json.dump(index, f)
+	return index
+
+def load_index(path):
+	"""returns the index of the archive in the directory at path."""
+	with open(os.path.join(path, INDEX_FNAME)) as f:
+		return json.load(f)
+
+def overlap(start1, length1, start2, length2):
+	"""returns the (start, stop) of the intersection of two ranges,
+	or None if they do not intersect."""
+	start, stop = max(start1, start2), min(start1 + length1, start2 + length2)
+	if start >= stop:
+		return None
+	return (start, stop)
+
+def query_archive(path, deg_bbox, start_date=None, end_date=None, index=None):
+	"""returns a tuple (dates, cube) holding the sorted dates between
+	start_date and end_date (inclusive, compared as date keys) and a
+	(time, height, width) array of the pixel values inside deg_bbox
+	for those dates. The bbox is converted to pixels exactly as in
+	pixel_coordinates, so the cube always has the requested shape;
+	pixels outside the archived region are set to MISSING. Only the
+	chunks which intersect the query are read. A previously loaded
+	index may be passed in to avoid reading it again."""
+	if index is None:
+		index = load_index(path)
+	pixel_bbox = pixel_coordinates(index['geotransform'], deg_bbox)
+	region = index['region']
+	num_dates, height, width = index['shape']
+	top = pixel_bbox['y'] - region['y']
+	left = pixel_bbox['x'] - region['x']
+	y_range = overlap(top, pixel_bbox['height'], 0, height)
+	x_range = overlap(left, pixel_bbox['width'], 0, width)
+	date_indices = [i for i, date in enumerate(index['dates'])
+		if (start_date is None or date >= start_date) and
+		(end_date is None or date <= end_date)]
+	dates = [index['dates'][i] for i in date_indices]
+	cube = np.full((len(dates), pixel_bbox['height'], pixel_bbox['width']),
+		MISSING, dtype=index['dtype'])
+	if not date_indices or y_range is None or x_range is None:
+		return (dates, cube)
+	t_range = (date_indices[0], date_indices[-1] + 1)
+	for chunk in index['chunks']:
+		t_part = overlap(chunk['t'], chunk['length'], t_range[0], t_range[1] - t_range[0])
+		y_part = overlap(chunk['y'], chunk['height'], y_range[0], y_range[1] - y_range[0])
+		x_part = overlap(chunk['x'], chunk['width'], x_range[0], x_range[1] - x_range[0])
+		if t_part is None or y_part is None or x_part is None:
+			continue
+		with np.load(os.path.join(path, chunk['fname'])) as archive:
+			data = archive['data']
+		cube[t_part[0] - t_range[0]:t_part[1] - t_range[0],
+			y_part[0] - top:y_part[1] - top,
+			x_part[0] - left:x_part[1] - left] = \
+			data[t_part[0] - chunk['t']:t_part[1] - chunk['t'],
+				y_part[0] - chunk['y']:y_part[1] - chunk['y'],
+				x_part[0] - chunk['x']:x_part[1] - chunk['x']]
+	return (dates, cube)
@@ -9,7 +9,11 @@ import unittest
 import gdal
 import numpy as np
 from country_window_processor import import_rst_files, get_geotransform 
-from country_window_processor import pixel_coordinates
+from country_window_processor import pixel_coordinates, read_window
+from country_window_processor import extract_windows, import_windows
+from country_window_processor import date_key, lazy_import_files
+from country_window_processor import covering_bbox, extract_country_windows
+from country_window_processor import group_bboxes
 
 def assert_dict_value_type_equal(dict1, dict2):
 	"""returns true if sample values from each dictionary
@@ -65,6 +69,96 @@ class TestCountryWindow(unittest.TestCase):
 		pixel_bbox = pixel_coordinates(self.sample_geotransform, deg_bbox)
 		self.assertEqual(self.sample_pixel_bbox, pixel_bbox)
 
+	def test_read_window(self):
+		"""check that a windowed read matches slicing the full 
+		band."""
+		gdal_instance = self.sample_data['2000_02']
+		full_band = gdal_instance.GetRasterBand(1).ReadAsArray()
+		bbox = self.sample_pixel_bbox
+		expected_window = full_band[bbox['y']:bbox['y'] + bbox['height'],
+			bbox['x']:bbox['x'] + bbox['width']]
+		window = read_window(gdal_instance, bbox)
+		np.testing.assert_array_equal(expected_window, window)
+
+	def test_extract_windows(self):
+		"""check that a window of the bounding box is extracted 
+		for every date."""
+		pixel_data = extract_windows(self.sample_data)
+		self.assertEqual(self.sample_data.keys(), pixel_data.keys())
+		self.assertEqual((128, 65), pixel_data['2000_02'].shape)
+
+	def test_date_key(self):
+		"""check that date keys are parsed for each raster format."""
+		self.assertEqual('2000_02', date_key('2000_02_ins_pt05deg.rst'))
+		self.assertEqual('2005', date_key('population_2005.tif'))
+		self.assertEqual('03', date_key('tmean03ag.bil'))
+
+	def test_import_windows(self):
+		"""check that concurrently imported windows match windows
+		extracted from the opened files."""
+		windows = import_windows(self.sample_path, '.rst', num_threads=2)
+		expected_windows = extract_windows(self.sample_data)
+		self.assertEqual(expected_windows.keys(), windows.keys())
+		np.testing.assert_array_equal(expected_windows['2000_02'], windows['2000_02'])
+
+	def test_lazy_import_files(self):
+		"""check that a lazy dataset has the same keys as an eager 
+		import, opens files only on access and answers 
+		get_geotransform."""
+		data = lazy_import_files(self.sample_path, '.rst', max_handles=1)
+		self.assertEqual(list(self.sample_data.keys()), list(data.keys()))
+		self.assertEqual(0, data.num_open())
+		self.assertEqual(self.sample_geotransform, get_geotransform(data))
+		self.assertEqual(1, data.num_open())
+		assert_dict_value_type_equal(self.sample_data, data)
+		data.close()
+		self.assertEqual(0, data.num_open())
+
+	def test_covering_bbox(self):
+		"""check that the covering bbox contains every bbox."""
+		pixel_bboxes = [
+			{'x': 10, 'y': 20, 'width': 5, 'height': 4},
+			{'x': 12, 'y': 15, 'width': 10, 'height': 2},
+		]
+		expected_bbox = {'x': 10, 'y': 15, 'width': 12, 'height': 9}
+		self.assertEqual(expected_bbox, covering_bbox(pixel_bboxes))
+
+	def test_group_bboxes(self):
+		"""check that nearby bboxes share a window and distant 
+		bboxes are read separately."""
+		pixel_bboxes = {
+			'a': {'x': 10, 'y': 20, 'width': 5, 'height': 4},
+			'b': {'x': 13, 'y': 22, 'width': 5, 'height': 4},
+			'c': {'x': 500, 'y': 300, 'width': 5, 'height': 4},
+		}
+		self.assertEqual([['a', 'b'], ['c']], group_bboxes(pixel_bboxes))
+		self.assertEqual([['a'], ['b'], ['c']], group_bboxes(pixel_bboxes, 1))
+
+	def test_extract_country_windows(self):
+		"""check that windows extracted together, whether grouped 
+		or not, match windows read separately for each country."""
+		deg_bboxes = {
+			'benin': {
+				'top_left_lat': 12.5,
+				'top_left_lon': 0.65,
+				'width': 3.25, 
+				'height': 6.4, 
+			},
+			'kenya': {
+				'top_left_lat': 4.5,
+				'top_left_lon': 33.5,
+				'width': 8.5,
+				'height': 9.5,
+			},
+		}
+		for max_overhead in [1.5, 100]:
+			country_data = extract_country_windows(self.sample_data, deg_bboxes,
+				max_overhead=max_overhead)
+			for country in deg_bboxes.keys():
+				expected_windows = extract_windows(self.sample_data, deg_bboxes[country])
+				np.testing.assert_array_equal(expected_windows['2000_02'],
+					country_data[country]['2000_02'])
+
 	def tearDown(self):
 		self.sample_data = None
 
@@ -0,0 +1,90 @@
+"""Add parent directory to path"""
+import os,sys,inspect
+currentdir_loc = os.path.abspath(inspect.getfile(inspect.currentframe()))
+currentdir = os.path.dirname(currentdir_loc)
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir) 
+
+import shutil
+import tempfile
+import unittest
+import gdal
+import numpy as np
+from country_window_processor import extract_windows
+from raster_archive import build_archive, load_index, query_archive
+
+
+class TestRasterArchive(unittest.TestCase):
+
+	def setUp(self):
+		"""builds a small archive from the sample data, covering 
+		a region around Benin split into several chunks."""
+		self.sample_path = currentdir + '/sample_data/'
+		self.sample_file = self.sample_path + '2000_02_ins_pt05deg.rst'
+		self.sample_data = {
+			'2000_02': gdal.Open(self.sample_file)
+		}
+		self.archive_path = tempfile.mkdtemp()
+		self.region = {
+			'top_left_lat': 15,
+			'top_left_lon': -2,
+			'width': 10,
+			'height': 12,
+		}
+		self.benin_bbox = {
+			'top_left_lat': 12.5,
+			'top_left_lon': 0.65,
+			'width': 3.25, 
+			'height': 6.4, 
+		}
+		build_archive(self.sample_data, self.archive_path, self.region,
+			tile_shape=(50, 60))
+
+	def test_index(self):
+		"""check that the index records the archive shape and
+		chunk extents."""
+		index = load_index(self.archive_path)
+		self.assertEqual([1, 240, 200], index['shape'])
+		self.assertEqual(['2000_02'], index['dates'])
+		self.assertEqual(5 * 4, len(index['chunks']))
+
+	def test_query_archive(self):
+		"""check that a query across several chunks matches a 
+		windowed read of the original raster."""
+		expected_windows = extract_windows(self.sample_data, self.benin_bbox)
+		dates, cube = query_archive(self.archive_path, self.benin_bbox)
+		self.assertEqual(['2000_02'], dates)
+		np.testing.assert_array_equal(expected_windows['2000_02'], cube[0])
+
+	def test_query_archive_region_edge(self):
+		"""check that a query straddling the edge of the archived
+		region keeps its shape, with MISSING outside the region."""
+		deg_bbox = {
+			'top_left_lat': 20,
+			'top_left_lon': -5,
+			'width': 10,
+			'height': 20,
+		}
+		expected_windows = extract_windows(self.sample_data, deg_bbox)
+		dates, cube = query_archive(self.archive_path, deg_bbox)
+		expected = expected_windows['2000_02']
+		self.assertEqual(expected.shape, cube[0].shape)
+		# the archived region covers rows 100 to 340 from column 60
+		inside = np.zeros(expected.shape, dtype=bool)
+		inside[100:340, 60:] = True
+		np.testing.assert_array_equal(expected[inside], cube[0][inside])
+		self.assertTrue(np.all(cube[0][~inside] == -999))
+
+	def test_query_archive_date_range(self):
+		"""check that dates outside the range are excluded."""
+		dates, cube = query_archive(self.archive_path, self.benin_bbox,
+			start_date='2001_01')
+		self.assertEqual([], dates)
+		self.assertEqual(0, cube.shape[0])
+
+	def tearDown(self):
+		self.sample_data = None
+		shutil.rmtree(self.archive_path)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,32 +1,202 @@
 import numpy as np
+from scipy.special import logsumexp
+from scipy.spatial import cKDTree
+from scipy.signal import fftconvolve
+
+"""Bound the number of entries in each block of the query x train
+distance matrix so that batch evaluation has a fixed memory footprint."""
+BLOCK_SIZE = 2 ** 22
+
+def squared_distances(points, train_data):
+	"""returns the (m x n) matrix of squared euclidean distances
+	between each of the m points and each of the n training points.
+	Both sets are centred on the training mean before the matrix
+	product to limit cancellation error."""
+	points = np.atleast_2d(points).astype(float)
+	train_data = np.atleast_2d(train_data).astype(float)
+	centre = train_data.mean(axis=0)
+	points = points - centre
+	train_data = train_data - centre
+	point_norms = np.sum(points ** 2, axis=1)[:, np.newaxis]
+	train_norms = np.sum(train_data ** 2, axis=1)[np.newaxis, :]
+	dists = point_norms + train_norms - 2 * np.dot(points, train_data.T)
+	return np.maximum(dists, 0)
+
+def kernel_log_densities(dists, bandwidth, dim):
+	"""returns the log probability of each row of an (m x n) matrix
+	of squared distances to n training points of dimension 'dim',
+	under Gaussian kernels of the given bandwidth. This lets callers
+	that vary only the bandwidth reuse one distance matrix."""
+	N = dists.shape[1]
+	exponents = -dists / (2 * (bandwidth ** 2))
+	log_constant = -(dim / 2) * np.log(2 * np.pi * bandwidth ** 2) - np.log(N)
+	return logsumexp(exponents, axis=1) + log_constant
 
 class Kde:
 
-	def __init__(self, train_data, bandwidth=1):
+	def __init__(self, train_data, bandwidth=1, tolerance=None):
+		"""'bandwidth' is either a scalar, giving an isotropic kernel,
+		or a vector of per-dimension bandwidths, giving a kernel with
+		a diagonal bandwidth matrix. If 'tolerance' is given,
+		densities are approximated with a KD-tree over the training
+		points: any kernel whose value is below 'tolerance' times its
+		peak value is ignored, so the absolute error in each density
+		is at most 'tolerance' times normalizing_constant()."""
 		self.train_data = train_data
 		self.bandwidth = bandwidth
+		self.tolerance = tolerance
+		self._tree = None
+		self._tree_bandwidths = None
+
+	def bandwidths(self):
+		"""returns the bandwidth of each dimension as an ndarray."""
+		dim = self.train_data.shape[1]
+		return np.broadcast_to(np.asarray(self.bandwidth, dtype=float), (dim,))
 
 	def normalizing_constant(self):
-		"""returns the normalizing constant associated 
+		"""returns the normalizing constant associated
 		with each Gaussian kernel"""
-		dim = self.train_data.shape[1]
-		return 1 / (2 * np.pi * ((self.bandwidth) ** 2)) ** (dim / 2) 
+		return 1 / np.prod(np.sqrt(2 * np.pi) * self.bandwidths())
 
 	def density(self, x):
-		"""returns the probability of the point x by constructing 
-		Gaussian kernels of the bandwidth specifice in 'init()' 
+		"""returns the probability of the point x by constructing
+		Gaussian kernels of the bandwidth specifice in 'init()'
 		over the training points."""
+		return self.density_many(x)[0]
+
+	def density_many(self, points):
+		"""returns an ndarray holding the probability of each
+		of the given points."""
+		return np.exp(self.log_density_many(points))
+
+	def log_density_many(self, points):
+		"""returns an ndarray holding the log probability of each
+		of the given points, using the tree approximation when a
+		tolerance was given in 'init()'."""
+		if len(np.atleast_2d(points)) == 0:
+			return np.empty(0)
+		if self.tolerance is None:
+			return self.exact_log_density_many(points)
+		return self.approximate_log_density_many(points)
+
+	def exact_log_density_many(self, points):
+		"""returns an ndarray holding the log probability of each
+		of the given points. The kernel sums are reduced with a
+		log-sum-exp, so points far from the training data receive
+		a finite (very negative) value instead of log(0)."""
+		points = np.atleast_2d(points)
+		rows = max(1, BLOCK_SIZE // len(self.train_data))
+		blocks = [self._log_density_block(points[start:start + rows])
+				for start in range(0, len(points), rows)]
+		return np.concatenate(blocks)
+
+	def _log_density_block(self, points):
+		"""returns the log probabilities of a block of points
+		using a single query x train distance matrix. Both sets
+		of points are measured in units of the bandwidths."""
+		bandwidths = self.bandwidths()
+		dists = squared_distances(points / bandwidths, self.train_data / bandwidths)
+		dim = self.train_data.shape[1]
+		return kernel_log_densities(dists, 1, dim) - np.sum(np.log(bandwidths))
+
+	def cutoff_radius(self):
+		"""returns the distance (in units of the bandwidths) beyond
+		which a kernel falls below 'tolerance' times its peak value."""
+		return np.sqrt(-2 * np.log(self.tolerance))
+
+	def kd_tree(self):
+		"""returns a KD-tree over the training points measured in
+		units of the bandwidths, building it on first use and again
+		whenever the bandwidth changes."""
+		bandwidths = self.bandwidths()
+		if self._tree is None or not np.array_equal(bandwidths, self._tree_bandwidths):
+			self._tree = cKDTree(self.train_data / bandwidths)
+			self._tree_bandwidths = np.copy(bandwidths)
+		return self._tree
+
+	def approximate_log_density_many(self, points):
+		"""returns an ndarray holding the approximate log probability
+		of each of the given points, summing only the kernels of
+		training points within cutoff_radius(). Points with no
+		training point inside the radius fall back to the exact sum.
+		Points are queried in blocks, so that the pairs found within
+		the radius never exceed BLOCK_SIZE."""
+		points = np.atleast_2d(points).astype(float)
+		rows = max(1, BLOCK_SIZE // len(self.train_data))
+		blocks = [self._approximate_log_density_block(points[start:start + rows])
+				for start in range(0, len(points), rows)]
+		return np.concatenate(blocks)
+
+	def _approximate_log_density_block(self, points):
+		"""returns the approximate log probabilities of a block of
+		points from a single sparse query x train distance matrix."""
+		N = len(self.train_data)
+		tree = self.kd_tree()
+		query_tree = cKDTree(points / self.bandwidths())
+		pairs = query_tree.sparse_distance_matrix(tree,
+				self.cutoff_radius(), output_type='ndarray')
+		rows = pairs['i']
+		exponents = -pairs['v'] ** 2 / 2
+		row_max = np.full(len(points), -np.inf)
+		np.maximum.at(row_max, rows, exponents)
+		sums = np.bincount(rows, np.exp(exponents - row_max[rows]),
+				minlength=len(points))
+		log_probs = np.empty(len(points))
+		found = sums > 0
+		log_constant = np.log(self.normalizing_constant()) - np.log(N)
+		log_probs[found] = row_max[found] + np.log(sums[found]) + log_constant
+		if not found.all():
+			log_probs[~found] = self.exact_log_density_many(points[~found])
+		return log_probs
+
+	def density_grid(self, geotransform, pixel_bbox, truncate=4.0):
+		"""returns a (height x width) ndarray of probabilities at
+		the pixel centres of the raster window 'pixel_bbox' (in the
+		format returned by country_window.pixel_coordinates) on the
+		grid described by the gdal 'geotransform'.
+
+		The training data must be two dimensional with columns
+		(lon, lat). Training points are linearly binned onto the
+		pixel grid, padded by 'truncate' bandwidths on each side so
+		points just outside the window still contribute, and the
+		bin counts are convolved with the Gaussian kernel via FFT."""
+		if self.train_data.shape[1] != 2:
+			raise ValueError('density_grid requires (lon, lat) training data')
 		N = len(self.train_data)
-		points = list(self.train_data)
-		dists = [np.linalg.norm(x-point)**2 for point in points]
-		exps = [np.exp(-dist / (2 * (self.bandwidth ** 2))) for dist in dists]
-		unnormalized_sum = sum(exps)
-		probability = (1 / N) * self.normalizing_constant() * unnormalized_sum
-		return probability
+		origin_x, origin_y = geotransform[0], geotransform[3]
+		pixel_width, pixel_height = geotransform[1], geotransform[5]
+		width, height = pixel_bbox['width'], pixel_bbox['height']
+		bandwidth_x, bandwidth_y = self.bandwidths()
+		pad_x = int(np.ceil(truncate * bandwidth_x / abs(pixel_width)))
+		pad_y = int(np.ceil(truncate * bandwidth_y / abs(pixel_height)))
+		grid_shape = (height + 2 * pad_y, width + 2 * pad_x)
+		# fractional pixel positions, with pixel centres at integers
+		cols = (self.train_data[:, 0] - origin_x) / pixel_width
+		cols = cols - pixel_bbox['x'] - 0.5 + pad_x
+		rows = (self.train_data[:, 1] - origin_y) / pixel_height
+		rows = rows - pixel_bbox['y'] - 0.5 + pad_y
+		inside = ((cols >= 0) & (cols < grid_shape[1] - 1) &
+				(rows >= 0) & (rows < grid_shape[0] - 1))
+		cols, rows = cols[inside], rows[inside]
+		col0, row0 = np.floor(cols).astype(int), np.floor(rows).astype(int)
+		col_frac, row_frac = cols - col0, rows - row0
+		counts = np.zeros(grid_shape)
+		for d_row, row_weight in ((0, 1 - row_frac), (1, row_frac)):
+			for d_col, col_weight in ((0, 1 - col_frac), (1, col_frac)):
+				cells = np.ravel_multi_index((row0 + d_row, col0 + d_col), grid_shape)
+				counts.flat += np.bincount(cells, row_weight * col_weight,
+						minlength=counts.size)
+		offsets_x = np.arange(-pad_x, pad_x + 1) * pixel_width
+		offsets_y = np.arange(-pad_y, pad_y + 1) * pixel_height
+		kernel_x = np.exp(-offsets_x ** 2 / (2 * bandwidth_x ** 2))
+		kernel_y = np.exp(-offsets_y ** 2 / (2 * bandwidth_y ** 2))
+		kernel = np.outer(kernel_y, kernel_x)
+		smoothed = fftconvolve(counts, kernel, mode='same')
+		window = smoothed[pad_y:pad_y + height, pad_x:pad_x + width]
+		probabilities = (1 / N) * self.normalizing_constant() * window
+		return np.maximum(probabilities, 0)
 
 	def log_likelihood(self, points):
 		"""returns the log likelihood of 'points' arising from
 		the distribution described by density()"""
-		point_set = list(points)
-		log_probabilities = [np.log(self.density(point)) for point in point_set]
-		return sum(log_probabilities)
\ No newline at end of file
+		return np.sum(self.log_density_many(points))
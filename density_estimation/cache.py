@@ -0,0 +1,106 @@
+"""cache provides a persistent store for the results of bandwidth
+selection, so that repeated calls on the same data (e.g. after a
+notebook kernel restart) return without recomputation. Entries are
+keyed by a content hash of the data and a hash of the parameters, and
+the least recently used entries are evicted once the store grows
+beyond a size limit."""
+
+import os
+import pickle
+import hashlib
+import numpy as np
+
+"""Provide the default location of the cache on disk."""
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'malaria_scripts')
+"""Provide the default size limit of the cache in bytes."""
+MAX_CACHE_BYTES = 100 * 2 ** 20
+"""Cache files use this extension."""
+CACHE_EXTENSION = '.pkl'
+
+def data_hash(data):
+	"""returns a hex digest of the contents, shape and dtype
+	of an ndarray."""
+	data = np.ascontiguousarray(data)
+	digest = hashlib.sha1()
+	digest.update(str((data.dtype.str, data.shape)).encode('utf-8'))
+	digest.update(data.tobytes())
+	return digest.hexdigest()
+
+def params_hash(name, params):
+	"""returns a hex digest of a function name and a dict of
+	its parameters."""
+	key = repr((name, sorted(params.items())))
+	return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+class ResultCache:
+
+	def __init__(self, path=CACHE_PATH, max_bytes=MAX_CACHE_BYTES):
+		self.path = path
+		self.max_bytes = max_bytes
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+	def entry_path(self, data, name, params):
+		"""returns the file which holds the result of calling the
+		function 'name' on data with the given parameters."""
+		fname = data_hash(data) + '_' + params_hash(name, params) + CACHE_EXTENSION
+		return os.path.join(self.path, fname)
+
+	def entries(self):
+		"""returns a list of the paths of all cache files."""
+		fnames = next(os.walk(self.path))[2]
+		return [os.path.join(self.path, fname) for fname in fnames
+				if fname.endswith(CACHE_EXTENSION)]
+
+	def size(self):
+		"""returns the total size of the cache files in bytes."""
+		return sum(os.path.getsize(entry) for entry in self.entries())
+
+	def get(self, data, name, params):
+		"""returns a tuple (found, value) for the stored result,
+		marking the entry as recently used."""
+		entry = self.entry_path(data, name, params)
+		if not os.path.exists(entry):
+			return (False, None)
+		with open(entry, 'rb') as f:
+			value = pickle.load(f)
+		os.utime(entry, None)
+		return (True, value)
+
+	def put(self, data, name, params, value):
+		"""stores a result, then evicts old entries if the cache
+		has outgrown max_bytes."""
+		entry = self.entry_path(data, name, params)
+		partial = entry + '.tmp'
+		with open(partial, 'wb') as f:
+			pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+		os.rename(partial, entry)
+		self.evict()
+
+	def cached(self, name, data, params, compute):
+		"""returns the stored result of the function 'name' on data
+		with the given parameters, calling compute() and storing its
+		result if there is none."""
+		found, value = self.get(data, name, params)
+		if not found:
+			value = compute()
+			self.put(data, name, params, value)
+		return value
+
+	def evict(self):
+		"""removes the least recently used entries until the cache
+		is no larger than max_bytes."""
+		entries = sorted(self.entries(), key=os.path.getmtime)
+		total = sum(os.path.getsize(entry) for entry in entries)
+		while entries and total > self.max_bytes:
+			oldest = entries.pop(0)
+			total -= os.path.getsize(oldest)
+			os.remove(oldest)
+
+	def invalidate(self, data=None):
+		"""removes every entry computed from 'data', or every
+		entry if no data is given."""
+		prefix = None if data is None else data_hash(data) + '_'
+		for entry in self.entries():
+			if prefix is None or os.path.basename(entry).startswith(prefix):
+				os.remove(entry)
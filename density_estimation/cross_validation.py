@@ -1,10 +1,20 @@
 import math
 import numpy as np
 import itertools
-from Kde import Kde
-from scipy.optimize import minimize_scalar
+from Kde import Kde, squared_distances, kernel_log_densities
+from scipy.optimize import minimize_scalar, minimize
+from scipy.special import logsumexp
 from sklearn.cross_validation import KFold
 from collections import defaultdict
+from multiprocessing import Pool
+
+"""Bound the number of entries in each (bandwidth x test x train)
+block evaluated when scoring a grid of bandwidths at once."""
+MAX_BLOCK_ELEMENTS = 2 ** 24
+"""Provide the limits of the bounded bandwidth search."""
+BANDWIDTH_BOUNDS = (0.001, 10)
+"""Name the kernel used, so cached results are tied to it."""
+KERNEL = 'gaussian'
 
 def k_folds(data, num_folds):
 	"""returns a list of training-test pairs. Each pair 
@@ -25,6 +35,62 @@ def k_folds(data, num_folds):
 	combinations = [[data[train, :], data[test, :]] for train, test in kf]
 	return combinations
 
+def run_seeds(num_runs, seed=None):
+	"""returns an array of 'num_runs' seeds derived from 'seed'.
+	Each run shuffles the data with its own seed, so results do not
+	depend on how the runs are distributed across workers.
+
+	Parameters
+	----------
+	num_runs : int
+		The number of runs that need a seed.
+	seed : int or None
+		The master seed. If None, fresh entropy is used.
+	"""
+	return np.random.RandomState(seed).randint(2 ** 31 - 1, size=num_runs)
+
+def shuffled(data, seed):
+	"""returns a copy of data with its rows shuffled by a generator
+	seeded with 'seed'. The input array is left untouched.
+
+	Parameters
+	----------
+	data : (n x d) ndarray 
+		Array of n data points of dimension d.
+	seed : int
+		The seed for this shuffle.
+	"""
+	permutation = np.random.RandomState(seed).permutation(data.shape[0])
+	return data[permutation]
+
+def map_runs(func, args, num_workers=1, pool=None):
+	"""returns [func(arg) for arg in args], dispatching the calls
+	to a pool of 'num_workers' processes when more than one worker
+	is requested.
+
+	Parameters
+	----------
+	func : function
+		A module level function (so that it can be pickled).
+	args : list
+		The argument for each call.
+	num_workers : int
+		The number of worker processes.
+	pool : multiprocessing.Pool or None
+		An existing pool to reuse across calls. If given,
+		num_workers is ignored and the pool is left open.
+	"""
+	if pool is not None:
+		return pool.map(func, args)
+	if num_workers <= 1:
+		return [func(arg) for arg in args]
+	pool = Pool(num_workers)
+	try:
+		return pool.map(func, args)
+	finally:
+		pool.close()
+		pool.join()
+
 def log_likelihood(pair, bandwidth):
 	"""returns the likelihood of the test data having arisen
 	a kernel trained on the training data with the given 
@@ -44,9 +110,23 @@ def log_likelihood(pair, bandwidth):
 	log_lhood = kde.log_likelihood(pair[1])
 	return log_lhood
 
+def fold_distances(pair):
+	"""returns the (test x train) matrix of squared distances
+	between the test and training data of a pair.
+
+	Parameters
+	----------
+	pair : list
+		A list with two entries which contain the training
+		and test data. 
+	"""
+	return squared_distances(pair[1], pair[0])
+
 def neg_log_likelilhood(pair):
 	"""returns the a negative log likelihood function object
 	which can be passed to the optimizer to find the optimal 
+	bandwidth. The test x train distance matrix is computed
+	once, so each call only re-applies the kernel for the new
 	bandwidth.
 
 	Parameters
@@ -55,11 +135,46 @@ def neg_log_likelilhood(pair):
 		A list with two entries which contain the training
 		and test data. 
 	"""
+	dists = fold_distances(pair)
+	dim = pair[0].shape[1]
 	def neg_log_llhood(bandwidth):
-		neg = -1 * log_likelihood(pair, bandwidth)		
+		neg = -1 * np.sum(kernel_log_densities(dists, bandwidth, dim))
 		return neg
 	return neg_log_llhood
 
+def bandwidth_log_likelihoods(pair, bandwidths, max_elements=MAX_BLOCK_ELEMENTS):
+	"""returns an ndarray with the log likelihood of the test data
+	for each of the given bandwidths. The test data is taken in
+	blocks of rows; each block's distance matrix is computed once
+	and broadcast against blocks of bandwidths, and the per-row log
+	likelihoods are summed across blocks.
+
+	Parameters
+	----------
+	pair : list
+		A list with two entries which contain the training
+		and test data. 
+	bandwidths : (b,) ndarray
+		The candidate bandwidths.
+	max_elements : int
+		The largest number of (bandwidth x test x train) entries
+		held in memory at once.
+	"""
+	train, test = pair
+	num_train, dim = train.shape
+	bandwidths = np.asarray(bandwidths, dtype=float)
+	log_constants = -(dim / 2) * np.log(2 * np.pi * bandwidths ** 2) - np.log(num_train)
+	log_lhoods = len(test) * log_constants
+	rows = max(1, max_elements // num_train)
+	for row in range(0, len(test), rows):
+		dists = fold_distances([train, test[row:row + rows]])
+		block_size = max(1, max_elements // dists.size)
+		for start in range(0, len(bandwidths), block_size):
+			block = bandwidths[start:start + block_size]
+			exponents = -dists[np.newaxis] / (2 * block[:, np.newaxis, np.newaxis] ** 2)
+			log_lhoods[start:start + block_size] += logsumexp(exponents, axis=2).sum(axis=1)
+	return log_lhoods
+
 def cross_validated_bandwidths(data, num_folds):
 	"""returns a list of optimal bandwidths that are calculated
 	using cross validation.
@@ -75,13 +190,175 @@ def cross_validated_bandwidths(data, num_folds):
 	validated_bandwidths = []
 	for pair in pairs:
 		neg_log_llhood = neg_log_likelilhood(pair)	
-		optimal = minimize_scalar(neg_log_llhood, bounds=(0.001, 10), method='bounded')
+		optimal = minimize_scalar(neg_log_llhood, bounds=BANDWIDTH_BOUNDS, method='bounded')
 		validated_bandwidths.append(optimal['x'])
 	return validated_bandwidths
 
-def average_bandwith(data, num_runs=100, num_folds=5):
+def loo_distances(data):
+	"""returns the (n x n) matrix of squared distances between the
+	data points, with an infinite diagonal so that each point's own
+	kernel contributes nothing to its density.
+
+	Parameters
+	----------
+	data : (n x d) ndarray 
+		Array of n data points of dimension d.
+	"""
+	dists = squared_distances(data, data)
+	np.fill_diagonal(dists, np.inf)
+	return dists
+
+def neg_loo_log_likelihood(data):
+	"""returns a negative leave-one-out log likelihood function
+	object which can be passed to the optimizer. Each point is
+	scored under a kernel trained on the other n - 1 points, all
+	from a single pairwise distance matrix.
+
+	Parameters
+	----------
+	data : (n x d) ndarray 
+		Array of n data points of dimension d.
+	"""
+	dists = loo_distances(data)
+	num_points, dim = data.shape
+	correction = np.log(num_points) - np.log(num_points - 1)
+	def neg_loo_llhood(bandwidth):
+		log_probs = kernel_log_densities(dists, bandwidth, dim) + correction
+		return -1 * np.sum(log_probs)
+	return neg_loo_llhood
+
+def loo_log_likelihood(data, bandwidth):
+	"""returns the leave-one-out log likelihood of the data for
+	the given bandwidth.
+
+	Parameters
+	----------
+	data : (n x d) ndarray 
+		Array of n data points of dimension d.
+	bandwidth : float
+		the bandwidth used to construct the kernel.
+	"""
+	return -1 * neg_loo_log_likelihood(data)(bandwidth)
+
+def loo_bandwidth(data, bounds=BANDWIDTH_BOUNDS):
+	"""returns a tuple of the bandwidth which maximizes the 
+	leave-one-out log likelihood and that log likelihood. Unlike
+	average_bandwith this involves no shuffling or repeated runs,
+	but it holds an (n x n) distance matrix in memory.
+
+	Parameters
+	----------
+	data : (n x d) ndarray 
+		Array of n data points of dimension d.
+	bounds : tuple
+		The lower and upper limits of the bandwidth search.
+	"""
+	neg_loo_llhood = neg_loo_log_likelihood(data)
+	optimal = minimize_scalar(neg_loo_llhood, bounds=bounds, method='bounded')
+	return (optimal['x'], -1 * optimal['fun'])
+
+def dimension_distances(pair):
+	"""returns a (d x test x train) ndarray holding, for each
+	dimension, the squared differences between the test and
+	training data of a pair.
+
+	Parameters
+	----------
+	pair : list
+		A list with two entries which contain the training
+		and test data. 
+	"""
+	train, test = pair
+	diffs = test.T[:, :, np.newaxis] - train.T[:, np.newaxis, :]
+	return diffs ** 2
+
+def neg_log_likelihood_and_gradient(pairs, max_elements=MAX_BLOCK_ELEMENTS):
+	"""returns a function object which maps a vector of log
+	bandwidths (one per dimension) to the negative log likelihood
+	summed over the folds and its analytic gradient. With weights
+	w_ij given by the softmax of the kernel exponents over the
+	training points j, the derivative of log p(x_i) with respect
+	to log h_k is sum_j w_ij (x_ik - y_jk)^2 / h_k^2 - 1. The
+	squared differences are recomputed on each call for one block
+	of test rows at a time, so memory does not grow with the folds.
+
+	Parameters
+	----------
+	pairs : list
+		A list of training-test pairs, as returned by k_folds.
+	max_elements : int
+		The largest number of (d x test x train) entries held in
+		memory at once.
+	"""
+	def neg_llhood_and_grad(log_bandwidths):
+		inv_variances = np.exp(-2 * log_bandwidths)
+		dim = len(log_bandwidths)
+		neg_llhood = 0
+		grad = np.zeros(dim)
+		for train, test in pairs:
+			num_test, num_train = len(test), len(train)
+			log_constant = (-(dim / 2) * np.log(2 * np.pi) - np.sum(log_bandwidths)
+					- np.log(num_train))
+			neg_llhood -= num_test * log_constant
+			grad += num_test
+			rows = max(1, max_elements // (dim * num_train))
+			for start in range(0, num_test, rows):
+				dists = dimension_distances([train, test[start:start + rows]])
+				scaled = dists * inv_variances[:, np.newaxis, np.newaxis]
+				exponents = -0.5 * scaled.sum(axis=0)
+				log_sums = logsumexp(exponents, axis=1)
+				weights = np.exp(exponents - log_sums[:, np.newaxis])
+				neg_llhood -= np.sum(log_sums)
+				grad -= np.einsum('ij,kij->k', weights, scaled)
+		return (neg_llhood, grad)
+	return neg_llhood_and_grad
+
+def diagonal_bandwidths(data, num_folds=5, initial=None, bounds=BANDWIDTH_BOUNDS):
+	"""returns an ndarray of per-dimension bandwidths which minimize
+	the cross validated negative log likelihood. The optimization runs
+	over log bandwidths with L-BFGS-B using the analytic gradient.
+
+	Parameters
+	----------
+	data : (n x d) ndarray 
+		Array of n data points of dimension d.
+	num_folds : int
+		The number of folds used to perform the cross validation.
+	initial : (d,) ndarray
+		The starting bandwidths. Defaults to scott's rule applied
+		to the standard deviation of each dimension.
+	bounds : tuple
+		The lower and upper limits of each bandwidth.
+	"""
+	num_points, dim = data.shape
+	if initial is None:
+		initial = data.std(axis=0) * num_points ** (-1 / (dim + 4))
+	initial = np.clip(initial, bounds[0], bounds[1])
+	objective = neg_log_likelihood_and_gradient(k_folds(data, num_folds))
+	log_bounds = [(np.log(bounds[0]), np.log(bounds[1]))] * dim
+	optimal = minimize(objective, np.log(initial), jac=True,
+			method='L-BFGS-B', bounds=log_bounds)
+	return np.exp(optimal['x'])
+
+def cache_params(**params):
+	"""returns the dict of parameters identifying a cached result,
+	including the bandwidth bounds and kernel in use."""
+	params['bounds'] = BANDWIDTH_BOUNDS
+	params['kernel'] = KERNEL
+	return params
+
+def bandwidth_run(args):
+	"""returns the cross validated bandwidths of a single run, given
+	a tuple of (data, num_folds, seed)."""
+	data, num_folds, seed = args
+	return cross_validated_bandwidths(shuffled(data, seed), num_folds)
+
+def average_bandwith(data, num_runs=100, num_folds=5, num_workers=1, seed=None,
+		cache=None):
 	"""returns the optimal bandwith (on average) computed over the number 
-	of runs specified in num_runs using k-fold validation.
+	of runs specified in num_runs using k-fold validation. Each run
+	shuffles its own copy of the data, so the result depends only on
+	'seed' and not on 'num_workers'.
 
 	Parameters
 	----------
@@ -91,16 +368,88 @@ def average_bandwith(data, num_runs=100, num_folds=5):
 		The number of runs over which the average is calculated.
 	num_folds : int
 		The number of folds used to perform the cross validation.
+	num_workers : int
+		The number of processes the runs are distributed across.
+	seed : int or None
+		The seed from which each run's shuffle is derived.
+	cache : cache.ResultCache or None
+		If given, the result is read from (or stored in) the cache.
+		Unseeded runs are never cached, since each call draws
+		different shuffles.
 	"""
+	if cache is not None and seed is not None:
+		params = cache_params(num_runs=num_runs, num_folds=num_folds, seed=seed)
+		compute = lambda: average_bandwith(data, num_runs, num_folds, num_workers, seed)
+		return cache.cached('average_bandwith', data, params, compute)
+	args = [(data, num_folds, run_seed) for run_seed in run_seeds(num_runs, seed)]
 	bandwidths = []
-	for run in range(num_runs):
-		np.random.shuffle(data)
-		validated_bandwidths = cross_validated_bandwidths(data, num_folds)
+	for validated_bandwidths in map_runs(bandwidth_run, args, num_workers):
 		bandwidths.extend(validated_bandwidths)
 	average = sum(bandwidths) / len(bandwidths)
 	return (average, bandwidths)
 
-def cross_validated_likelihoods(data, num_folds, bandwidth):
+def standard_error(values):
+	"""returns the standard error of the mean of 'values'."""
+	values = np.asarray(values, dtype=float)
+	return values.std(ddof=1) / np.sqrt(len(values))
+
+def adaptive_average_bandwith(data, tolerance, min_runs=10, max_runs=100,
+		num_folds=5, num_workers=1, seed=None):
+	"""returns a tuple of the optimal bandwidth (on average), the list
+	of fold bandwidths and the number of runs used. Runs stop as soon
+	as the standard error of the mean of the per-run average bandwidths
+	falls below 'tolerance', after at least 'min_runs' and at most
+	'max_runs' runs. Runs are checked in order, so the stopping point
+	depends only on 'seed' and not on 'num_workers'.
+
+	Parameters
+	----------
+	data : (n x d) ndarray 
+		Array of n data points of dimension d.
+	tolerance : float
+		The standard error at which to stop.
+	min_runs : int
+		The smallest number of runs performed (at least 2).
+	max_runs : int
+		The largest number of runs performed.
+	num_folds : int
+		The number of folds used to perform the cross validation.
+	num_workers : int
+		The number of processes the runs are distributed across.
+	seed : int or None
+		The seed from which each run's shuffle is derived.
+	"""
+	min_runs = max(2, min_runs)
+	seeds = run_seeds(max_runs, seed)
+	batch_size = max(1, num_workers)
+	pool = Pool(num_workers) if num_workers > 1 else None
+	run_bandwidths = []
+	num_runs = None
+	try:
+		while num_runs is None and len(run_bandwidths) < max_runs:
+			start = len(run_bandwidths)
+			args = [(data, num_folds, run_seed)
+					for run_seed in seeds[start:start + batch_size]]
+			for validated_bandwidths in map_runs(bandwidth_run, args, pool=pool):
+				run_bandwidths.append(validated_bandwidths)
+				run_means = [np.mean(run) for run in run_bandwidths]
+				if (len(run_means) >= min_runs and
+						standard_error(run_means) < tolerance):
+					num_runs = len(run_means)
+					break
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	if num_runs is None:
+		num_runs = len(run_bandwidths)
+	bandwidths = []
+	for validated_bandwidths in run_bandwidths[:num_runs]:
+		bandwidths.extend(validated_bandwidths)
+	average = sum(bandwidths) / len(bandwidths)
+	return (average, bandwidths, num_runs)
+
+def cross_validated_likelihoods(data, num_folds, bandwidth, cache=None):
 	"""returns a list of negative log likelihoods that are 
 	calculated using cross validation.
 
@@ -112,7 +461,13 @@ def cross_validated_likelihoods(data, num_folds, bandwidth):
 		The number of folds used to perform the cross validation.
 	bandwidth : float
 		the bandwidth used to construct the kernel.
+	cache : cache.ResultCache or None
+		If given, the result is read from (or stored in) the cache.
 	"""
+	if cache is not None:
+		params = cache_params(num_folds=num_folds, bandwidth=bandwidth)
+		compute = lambda: cross_validated_likelihoods(data, num_folds, bandwidth)
+		return cache.cached('cross_validated_likelihoods', data, params, compute)
 	pairs = k_folds(data, num_folds)
 	validated_likelihoods = []
 	for pair in pairs:
@@ -121,7 +476,71 @@ def cross_validated_likelihoods(data, num_folds, bandwidth):
 		validated_likelihoods.append(neg_llhood)
 	return validated_likelihoods
 
-def average_log_likelihood(data, bandwidth, num_runs=100, num_folds=5):
+def cross_validated_likelihood_curve(data, num_folds, bandwidths,
+		max_elements=MAX_BLOCK_ELEMENTS):
+	"""returns a (num_folds x b) ndarray of negative log likelihoods,
+	one row per fold and one column per candidate bandwidth, computed
+	in a single pass over each fold.
+
+	Parameters
+	----------
+	data : (n x d) ndarray 
+		Array of n data points of dimension d.
+	num_folds : int
+		The number of folds used to perform the cross validation.
+	bandwidths : (b,) ndarray
+		The candidate bandwidths.
+	max_elements : int
+		The largest number of (bandwidth x test x train) entries
+		held in memory at once.
+	"""
+	pairs = k_folds(data, num_folds)
+	curves = [-1 * bandwidth_log_likelihoods(pair, bandwidths, max_elements)
+			for pair in pairs]
+	return np.array(curves)
+
+def likelihood_curve_run(args):
+	"""returns the likelihood curve of a single run, given a tuple
+	of (data, num_folds, bandwidths, seed)."""
+	data, num_folds, bandwidths, seed = args
+	return cross_validated_likelihood_curve(shuffled(data, seed), num_folds, bandwidths)
+
+def average_log_likelihood_curve(data, bandwidths, num_runs=100, num_folds=5,
+		num_workers=1, seed=None):
+	"""returns an ndarray holding the average negative log-likelihood
+	for each of the given bandwidths, computed over 'num_runs' runs of
+	k-fold validation. This is equivalent to calling
+	average_log_likelihood once per bandwidth, but every bandwidth is
+	scored from the same per-fold distance matrices.
+
+	Parameters
+	----------
+	data : (n x d) ndarray 
+		Array of n data points of dimension d.
+	bandwidths : (b,) ndarray
+		The candidate bandwidths.
+	num_runs : int
+		The number of runs over which the average is calculated.
+	num_folds : int
+		The number of folds used to perform the cross validation.
+	num_workers : int
+		The number of processes the runs are distributed across.
+	seed : int or None
+		The seed from which each run's shuffle is derived.
+	"""
+	args = [(data, num_folds, bandwidths, run_seed)
+			for run_seed in run_seeds(num_runs, seed)]
+	curves = map_runs(likelihood_curve_run, args, num_workers)
+	return np.concatenate(curves).mean(axis=0)
+
+def likelihood_run(args):
+	"""returns the cross validated likelihoods of a single run, given
+	a tuple of (data, num_folds, bandwidth, seed)."""
+	data, num_folds, bandwidth, seed = args
+	return cross_validated_likelihoods(shuffled(data, seed), num_folds, bandwidth)
+
+def average_log_likelihood(data, bandwidth, num_runs=100, num_folds=5,
+		num_workers=1, seed=None):
 	"""returns the average negative log-likelihood of the data arising
 	from KDE using the given bandwidth. The average is computed 
 	over 'num_runs' runs of k-fold validation where k is specified 
@@ -137,10 +556,15 @@ def average_log_likelihood(data, bandwidth, num_runs=100, num_folds=5):
 		The number of runs over which the average is calculated.
 	num_folds : int
 		The number of folds used to perform the cross validation.
+	num_workers : int
+		The number of processes the runs are distributed across.
+	seed : int or None
+		The seed from which each run's shuffle is derived.
 	"""
+	args = [(data, num_folds, bandwidth, run_seed)
+			for run_seed in run_seeds(num_runs, seed)]
 	llikelihoods = []
-	for run in range(num_runs):
-		np.random.shuffle(data)
-		llikelihoods.extend(cross_validated_likelihoods(data, num_folds, bandwidth))
+	for validated_likelihoods in map_runs(likelihood_run, args, num_workers):
+		llikelihoods.extend(validated_likelihoods)
 	average = sum(llikelihoods) / len(llikelihoods)
 	return average
@@ -1,30 +1,88 @@
 import numpy as np
-from scipy.spatial.distance import euclidean
+from multiprocessing import Pool
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from scipy.stats import norm
+
+"""Bound the number of pairwise distances held in memory at once."""
+BLOCK_SIZE = 2 ** 22
+"""Bound the number of samples drawn when estimating to a precision."""
+MAX_SAMPLES = 10 ** 6
+"""Name the columns of the table returned by heuristics_report."""
+REPORT_FIELDS = ['num_points', 'dim', 'scott', 'silverman',
+		'mean_distance', 'mean_min_distance']
 
 def mean_distance(data):
 	"""returns the mean pairwise distance between data points
-	(useful as sanity check for the bandwidth)."""
-	distances = []
-	for i in range(data.shape[0]):
-	    for j in range(data.shape[0]):
-	        if i != j:
-	            distances.append(euclidean(data[j,:].flatten(), data[i,:].flatten()))
-	mean_dist = sum(distances) / len(distances)
+	(useful as sanity check for the bandwidth). Distances are
+	computed in blocks of rows, so all n^2 distances are never
+	held in memory at once."""
+	num_points = data.shape[0]
+	rows = max(1, BLOCK_SIZE // num_points)
+	total = 0.
+	for start in range(0, num_points, rows):
+		total += cdist(data[start:start + rows], data).sum()
+	mean_dist = total / (num_points * (num_points - 1))
 	return mean_dist
 
-def mean_min_distance(data):
+def mean_min_distance(data, tree=None):
 	"""returns the mean distance to the next nearest point for 
-	each point in data."""
-	min_distances = []
-	for i in range(data.shape[0]):
-		distances = []
-		for j in range(data.shape[0]):
-			if i != j:
-				distances.append(euclidean(data[j,:].flatten(), data[i,:].flatten()))
-		min_distances.append(min(distances))
-	mean_min_dist = sum(min_distances) / len(min_distances)
+	each point in data, using a KD-tree nearest neighbour query.
+	A tree already built over data can be passed in as 'tree'."""
+	if tree is None:
+		tree = cKDTree(data)
+	distances, _ = tree.query(data, k=2)
+	mean_min_dist = distances[:, 1].mean()
 	return mean_min_dist
 
+def sampled_mean(sample, num_samples, precision=None, confidence=0.95,
+		max_samples=MAX_SAMPLES):
+	"""returns a tuple of the mean of the values drawn by 'sample'
+	and a (low, high) normal confidence interval for it. Batches
+	of 'num_samples' values are drawn until the half width of the
+	interval is at most 'precision' (or max_samples is reached);
+	with no precision a single batch is drawn."""
+	z = norm.ppf((1 + confidence) / 2)
+	values = sample(num_samples)
+	while True:
+		mean = values.mean()
+		half_width = z * values.std(ddof=1) / np.sqrt(len(values))
+		if (precision is None or half_width <= precision or
+				len(values) >= max_samples):
+			return (mean, (mean - half_width, mean + half_width))
+		values = np.concatenate((values, sample(num_samples)))
+
+def sampled_mean_distance(data, num_samples=10000, precision=None,
+		confidence=0.95, seed=None):
+	"""returns an estimate of mean_distance(data) from randomly
+	sampled pairs of distinct points, with a confidence interval
+	(see sampled_mean). The cost does not depend on the number of
+	points, and the result is fixed for a given seed."""
+	rng = np.random.RandomState(seed)
+	num_points = data.shape[0]
+	def sample(size):
+		first = rng.randint(num_points, size=size)
+		second = (first + rng.randint(1, num_points, size=size)) % num_points
+		return np.sqrt(np.sum((data[first] - data[second]) ** 2, axis=1))
+	return sampled_mean(sample, num_samples, precision, confidence)
+
+def sampled_mean_min_distance(data, num_samples=1000, precision=None,
+		confidence=0.95, seed=None, tree=None):
+	"""returns an estimate of mean_min_distance(data) from the
+	nearest neighbour distances of randomly sampled points, with a
+	confidence interval (see sampled_mean). A KD-tree over data is
+	built unless one is passed in as 'tree'; after that each sampled
+	point costs one O(log n) query. The result is fixed for a given
+	seed."""
+	rng = np.random.RandomState(seed)
+	if tree is None:
+		tree = cKDTree(data)
+	def sample(size):
+		points = data[rng.randint(data.shape[0], size=size)]
+		distances, _ = tree.query(points, k=2)
+		return distances[:, 1]
+	return sampled_mean(sample, num_samples, precision, confidence)
+
 def scott(data):
 	"""returns scotts rule of thumb value for the optimal
 	bandwidth on the given data."""
@@ -38,4 +96,64 @@ def silverman(data):
 	bandwidth on the given data."""
 	dim = data.shape[1]
 	silverman_factor = scott(data) * ( 4 / (dim + 2)) ** (-1 / (dim + 4))
-	return silverman_factor
\ No newline at end of file
+	return silverman_factor
+
+def dataset_heuristics(data, sampled=False, seed=None):
+	"""returns a dict holding every bandwidth heuristic for data,
+	keyed by the names in REPORT_FIELDS. A single KD-tree is built
+	and shared by the nearest neighbour heuristics. If 'sampled' is
+	True, the distance heuristics are replaced by their sampled
+	estimates."""
+	tree = cKDTree(data)
+	row = {
+		'num_points': data.shape[0],
+		'dim': data.shape[1],
+		'scott': scott(data),
+		'silverman': silverman(data),
+	}
+	if sampled:
+		row['mean_distance'] = sampled_mean_distance(data, seed=seed)[0]
+		row['mean_min_distance'] = sampled_mean_min_distance(data, seed=seed, tree=tree)[0]
+	else:
+		row['mean_distance'] = mean_distance(data)
+		row['mean_min_distance'] = mean_min_distance(data, tree=tree)
+	return row
+
+def heuristics_row(args):
+	"""returns the heuristics of one dataset, given a tuple of
+	(data, sampled, seed)."""
+	data, sampled, seed = args
+	return dataset_heuristics(data, sampled, seed)
+
+def heuristics_report(datasets, num_workers=1, sampled=False, seed=None):
+	"""returns a numpy record array with one row per dataset, holding
+	its name and every heuristic in REPORT_FIELDS, sorted by name.
+
+	Parameters
+	----------
+	datasets : dict
+		A mapping from name to an (n x d) ndarray of data points.
+	num_workers : int
+		The number of processes the datasets are distributed across.
+	sampled : bool
+		Whether to use the sampled distance estimates.
+	seed : int or None
+		The seed for the sampled distance estimates.
+	"""
+	names = sorted(datasets.keys())
+	args = [(datasets[name], sampled, seed) for name in names]
+	if num_workers <= 1:
+		rows = [heuristics_row(arg) for arg in args]
+	else:
+		pool = Pool(num_workers)
+		try:
+			rows = pool.map(heuristics_row, args)
+		finally:
+			pool.close()
+			pool.join()
+	dtype = [('name', 'U%d' % max([1] + [len(name) for name in names]))]
+	dtype += [(field, int if field in ('num_points', 'dim') else float)
+			for field in REPORT_FIELDS]
+	records = [tuple([name] + [row[field] for field in REPORT_FIELDS])
+			for name, row in zip(names, rows)]
+	return np.rec.array(records, dtype=dtype)
@@ -7,6 +7,7 @@ sys.path.insert(0,parentdir)
 
 import unittest
 import numpy as np
+import Kde as kde_module
 from Kde import Kde
 
 """Define the required accuracy for the numerical tests,
@@ -46,5 +47,98 @@ class TestKde(unittest.TestCase):
 		expected_log_lhood = -12.286938687661852
 		self.assertAlmostEqual(expected_log_lhood, log_lhood)
 
+	def test_bandwidth_vector(self):
+		"""check that a vector of bandwidths matches an isotropic
+		kernel over data rescaled in each dimension."""
+		rng = np.random.RandomState(0)
+		train_data = rng.randn(20, 2)
+		points = rng.randn(5, 2)
+		bandwidths = np.array([0.5, 2])
+		kde = Kde(train_data, bandwidths)
+		scaled = Kde(train_data / bandwidths, 1)
+		expected = scaled.density_many(points / bandwidths) / np.prod(bandwidths)
+		np.testing.assert_array_almost_equal(expected, kde.density_many(points), ACCURACY)
+
+	def test_density_many(self):
+		"""check that density_many agrees with density evaluated
+		one point at a time."""
+		train_data = np.array([[1,0],[2,0],[0,3]])
+		points = np.array([[2,0],[1.5,1],[-1,2]])
+		kde = Kde(train_data, 0.75)
+		expected = [kde.density(point) for point in points]
+		np.testing.assert_array_almost_equal(expected, kde.density_many(points), ACCURACY)
+
+	def test_log_likelihood_far_points(self):
+		"""check that log_likelihood remains finite for points far
+		from the training data."""
+		train_data = np.array([[1,0],[2,0]])
+		bandwidth = 0.5
+		points = np.array([[100,0]])
+		kde = Kde(train_data, bandwidth)
+		log_lhood = kde.log_likelihood(points)
+		expected_log_lhood = np.log(kde.normalizing_constant() / 2) - 98 ** 2 / (2 * bandwidth ** 2)
+		self.assertAlmostEqual(expected_log_lhood, log_lhood, 4)
+
+	def test_log_likelihood_no_points(self):
+		"""check that the log likelihood of no points is zero."""
+		kde = Kde(np.array([[1,0],[2,0]]), 0.5)
+		self.assertEqual(0, kde.log_likelihood(np.empty((0, 2))))
+		kde.tolerance = 1e-8
+		self.assertEqual((0,), kde.log_density_many(np.empty((0, 2))).shape)
+
+	def test_approximate_density_within_tolerance(self):
+		"""check that the tree approximation stays within the
+		requested tolerance of the exact density."""
+		rng = np.random.RandomState(0)
+		train_data = rng.randn(500, 2)
+		points = rng.randn(50, 2) * 2
+		tolerance = 1e-4
+		exact = Kde(train_data, 0.3)
+		approximate = Kde(train_data, 0.3, tolerance=tolerance)
+		error = np.abs(exact.density_many(points) - approximate.density_many(points))
+		self.assertTrue(np.all(error <= tolerance * exact.normalizing_constant()))
+
+	def test_approximate_density_blocks(self):
+		"""check that the tree approximation gives the same densities
+		when the points are queried in several blocks."""
+		rng = np.random.RandomState(0)
+		train_data = rng.randn(100, 2)
+		points = rng.randn(25, 2) * 2
+		kde = Kde(train_data, 0.3, tolerance=1e-4)
+		expected = kde.log_density_many(points)
+		block_size = kde_module.BLOCK_SIZE
+		kde_module.BLOCK_SIZE = 400
+		try:
+			blocked = kde.log_density_many(points)
+		finally:
+			kde_module.BLOCK_SIZE = block_size
+		np.testing.assert_array_almost_equal(expected, blocked)
+
+	def test_approximate_log_likelihood_far_points(self):
+		"""check that the tree approximation falls back to the exact
+		sum for points with no training data inside the cutoff."""
+		train_data = np.array([[1,0],[2,0]])
+		points = np.array([[100,0]])
+		exact = Kde(train_data, 0.5)
+		approximate = Kde(train_data, 0.5, tolerance=1e-6)
+		self.assertAlmostEqual(exact.log_likelihood(points), approximate.log_likelihood(points))
+
+	def test_density_grid(self):
+		"""check that the gridded density matches the exact density
+		at the pixel centres of the raster window."""
+		rng = np.random.RandomState(0)
+		train_data = np.column_stack((rng.uniform(0, 4, 1000), rng.uniform(6, 13, 1000)))
+		geotransform = (-180.0, 0.05, 0.0, 90.0, 0.0, -0.05)
+		pixel_bbox = {'x': 3613, 'y': 1550, 'width': 65, 'height': 128}
+		kde = Kde(train_data, 0.2)
+		grid = kde.density_grid(geotransform, pixel_bbox)
+		lons = -180.0 + (pixel_bbox['x'] + np.arange(65) + 0.5) * 0.05
+		lats = 90.0 - (pixel_bbox['y'] + np.arange(128) + 0.5) * 0.05
+		lon_grid, lat_grid = np.meshgrid(lons, lats)
+		centres = np.column_stack((lon_grid.ravel(), lat_grid.ravel()))
+		expected = kde.density_many(centres).reshape(128, 65)
+		self.assertEqual((128, 65), grid.shape)
+		self.assertTrue(np.abs(grid - expected).max() < 0.01 * expected.max())
+
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file
@@ -0,0 +1,77 @@
+"""Add parent directory to path"""
+import os,sys,inspect
+currentdir_loc = os.path.abspath(inspect.getfile(inspect.currentframe()))
+currentdir = os.path.dirname(currentdir_loc)
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir) 
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from cache import ResultCache, data_hash
+
+class TestResultCache(unittest.TestCase):
+
+	def setUp(self):
+		"""creates an empty cache in a temporary directory."""
+		self.path = tempfile.mkdtemp()
+		self.cache = ResultCache(self.path)
+		self.data = np.arange(10.).reshape(5, 2)
+		self.calls = []
+
+	def compute(self):
+		self.calls.append(1)
+		return (0.5, [0.4, 0.6])
+
+	def test_cached_result_is_reused(self):
+		"""check that a stored result is returned without calling
+		compute again, even from a fresh cache object."""
+		params = {'num_folds': 5, 'seed': 1}
+		first = self.cache.cached('average_bandwith', self.data, params, self.compute)
+		second = ResultCache(self.path).cached('average_bandwith',
+				np.copy(self.data), params, self.compute)
+		self.assertEqual(first, second)
+		self.assertEqual(1, len(self.calls))
+
+	def test_key_depends_on_data_and_params(self):
+		"""check that changing the data or a parameter misses
+		the cache."""
+		params = {'num_folds': 5, 'seed': 1}
+		self.cache.cached('average_bandwith', self.data, params, self.compute)
+		self.cache.cached('average_bandwith', self.data + 1, params, self.compute)
+		self.cache.cached('average_bandwith', self.data, {'num_folds': 5, 'seed': 2},
+				self.compute)
+		self.assertEqual(3, len(self.calls))
+		self.assertNotEqual(data_hash(self.data), data_hash(self.data.astype(np.float32)))
+
+	def test_invalidate(self):
+		"""check that invalidate removes only the entries of the
+		given data, or every entry when no data is given."""
+		params = {'num_folds': 5}
+		self.cache.put(self.data, 'f', params, 1)
+		self.cache.put(self.data + 1, 'f', params, 2)
+		self.cache.invalidate(self.data)
+		self.assertEqual((False, None), self.cache.get(self.data, 'f', params))
+		self.assertEqual((True, 2), self.cache.get(self.data + 1, 'f', params))
+		self.cache.invalidate()
+		self.assertEqual([], self.cache.entries())
+
+	def test_evict_least_recently_used(self):
+		"""check that the cache is trimmed to max_bytes by removing
+		the least recently used entries."""
+		self.cache.put(self.data, 'f', {'run': 0}, np.zeros(100))
+		entry_size = self.cache.size()
+		self.cache.max_bytes = 2 * entry_size
+		old = self.cache.entry_path(self.data, 'f', {'run': 0})
+		os.utime(old, (0, 0))
+		self.cache.put(self.data, 'f', {'run': 1}, np.zeros(100))
+		self.cache.put(self.data, 'f', {'run': 2}, np.zeros(100))
+		self.assertEqual(2, len(self.cache.entries()))
+		self.assertFalse(os.path.exists(old))
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -5,9 +5,18 @@ currentdir = os.path.dirname(currentdir_loc)
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
+import shutil
+import tempfile
 import unittest
 import numpy as np
-from cross_validation import k_folds
+from cache import ResultCache
+from cross_validation import k_folds, log_likelihood, neg_log_likelilhood
+from cross_validation import cross_validated_likelihoods, cross_validated_likelihood_curve
+from cross_validation import average_bandwith, loo_log_likelihood, loo_bandwidth
+from cross_validation import neg_log_likelihood_and_gradient, diagonal_bandwidths
+from cross_validation import adaptive_average_bandwith, bandwidth_run
+import cross_validation
+from Kde import Kde
 
 def sample_fold(scalar, rows, cols):
 	"""returns numpy array of dimension rows x cols
@@ -52,6 +61,173 @@ class TestFolds(unittest.TestCase):
 		for pairing1, pairing2 in zip(expected_combs, combinations):
 			assert_lists_of_ndarrays_equal(pairing1, pairing2)
 
+class TestLikelihoods(unittest.TestCase):
+
+	def test_neg_log_likelihood_reuses_distances(self):
+		"""check that the objective built from a precomputed distance
+		matrix agrees with a freshly constructed kernel for several
+		bandwidths."""
+		rng = np.random.RandomState(0)
+		pair = [rng.randn(40, 2), rng.randn(10, 2)]
+		neg_log_llhood = neg_log_likelilhood(pair)
+		for bandwidth in [0.05, 0.5, 3]:
+			expected = -1 * log_likelihood(pair, bandwidth)
+			self.assertAlmostEqual(expected, neg_log_llhood(bandwidth))
+
+	def test_cross_validated_likelihood_curve(self):
+		"""check that the likelihood curve matches per-bandwidth
+		cross validation, including when bandwidths and test rows
+		are split across several blocks."""
+		rng = np.random.RandomState(0)
+		data = rng.randn(30, 2)
+		bandwidths = np.array([0.1, 0.3, 1, 2])
+		for max_elements in [300, 50]:
+			curve = cross_validated_likelihood_curve(data, 3, bandwidths,
+					max_elements=max_elements)
+			self.assertEqual((3, 4), curve.shape)
+			for column, bandwidth in enumerate(bandwidths):
+				expected = cross_validated_likelihoods(data, 3, bandwidth)
+				np.testing.assert_array_almost_equal(expected, curve[:, column])
+
+	def test_loo_log_likelihood(self):
+		"""check that the leave-one-out likelihood matches fitting
+		a kernel to every subset of n - 1 points."""
+		rng = np.random.RandomState(0)
+		data = rng.randn(12, 2)
+		bandwidth = 0.6
+		expected = 0
+		for i in range(data.shape[0]):
+			kde = Kde(np.delete(data, i, axis=0), bandwidth)
+			expected += kde.log_likelihood(data[i:i + 1])
+		self.assertAlmostEqual(expected, loo_log_likelihood(data, bandwidth))
+
+	def test_loo_bandwidth(self):
+		"""check that the leave-one-out bandwidth maximizes the
+		leave-one-out likelihood."""
+		rng = np.random.RandomState(0)
+		data = rng.randn(50, 2)
+		bandwidth, log_lhood = loo_bandwidth(data)
+		self.assertAlmostEqual(loo_log_likelihood(data, bandwidth), log_lhood)
+		for other in [0.5 * bandwidth, 2 * bandwidth]:
+			self.assertTrue(loo_log_likelihood(data, other) < log_lhood)
+
+
+class TestDiagonalBandwidths(unittest.TestCase):
+
+	def test_neg_log_likelihood_and_gradient(self):
+		"""check the objective against Kde with a bandwidth vector
+		and the gradient against finite differences."""
+		rng = np.random.RandomState(0)
+		data = rng.randn(30, 3) * np.array([1, 5, 0.2])
+		pairs = k_folds(data, 3)
+		objective = neg_log_likelihood_and_gradient(pairs)
+		log_bandwidths = np.log(np.array([0.5, 2, 0.1]))
+		value, grad = objective(log_bandwidths)
+		expected = -1 * sum(Kde(train, np.exp(log_bandwidths)).log_likelihood(test)
+				for train, test in pairs)
+		self.assertAlmostEqual(expected, value)
+		blocked_value, blocked_grad = neg_log_likelihood_and_gradient(pairs,
+				max_elements=100)(log_bandwidths)
+		self.assertAlmostEqual(value, blocked_value)
+		np.testing.assert_array_almost_equal(grad, blocked_grad)
+		step = 1e-6
+		for k in range(3):
+			shift = np.zeros(3)
+			shift[k] = step
+			numerical = (objective(log_bandwidths + shift)[0] -
+					objective(log_bandwidths - shift)[0]) / (2 * step)
+			self.assertAlmostEqual(numerical, grad[k], 4)
+
+	def test_diagonal_bandwidths_follow_scale(self):
+		"""check that a dimension with a larger spread receives
+		a larger bandwidth."""
+		rng = np.random.RandomState(0)
+		data = rng.randn(60, 2) * np.array([0.1, 3])
+		bandwidths = diagonal_bandwidths(data, num_folds=3)
+		self.assertEqual((2,), bandwidths.shape)
+		self.assertTrue(bandwidths[1] > 5 * bandwidths[0])
+
+
+class TestRepeatedRuns(unittest.TestCase):
+
+	def test_average_bandwith_is_reproducible(self):
+		"""check that seeded runs give the same bandwidths whether
+		they run serially or in a process pool, and that the input
+		data is not shuffled in place."""
+		rng = np.random.RandomState(0)
+		data = rng.randn(20, 2)
+		original = np.copy(data)
+		serial = average_bandwith(data, num_runs=4, num_folds=2, seed=7)
+		parallel = average_bandwith(data, num_runs=4, num_folds=2, num_workers=2, seed=7)
+		self.assertAlmostEqual(serial[0], parallel[0])
+		np.testing.assert_array_almost_equal(serial[1], parallel[1])
+		np.testing.assert_array_equal(original, data)
+
+	def test_adaptive_average_bandwith(self):
+		"""check that adaptive runs stop within the run caps, agree
+		with the same number of fixed runs and do not depend on the
+		number of workers."""
+		rng = np.random.RandomState(0)
+		data = rng.randn(20, 2)
+		serial = adaptive_average_bandwith(data, tolerance=0.05, min_runs=3,
+				max_runs=8, num_folds=2, seed=7)
+		parallel = adaptive_average_bandwith(data, tolerance=0.05, min_runs=3,
+				max_runs=8, num_folds=2, num_workers=3, seed=7)
+		num_runs = serial[2]
+		self.assertTrue(3 <= num_runs <= 8)
+		self.assertEqual(num_runs, parallel[2])
+		self.assertAlmostEqual(serial[0], parallel[0])
+		fixed = average_bandwith(data, num_runs=num_runs, num_folds=2, seed=7)
+		self.assertAlmostEqual(fixed[0], serial[0])
+
+	def test_average_bandwith_cache(self):
+		"""check that a cached result matches the computed one
+		without running again, and that unseeded runs are not
+		cached."""
+		path = tempfile.mkdtemp()
+		runs = []
+		def counted_run(args):
+			runs.append(args)
+			return bandwidth_run(args)
+		cross_validation.bandwidth_run = counted_run
+		try:
+			cache = ResultCache(path)
+			data = np.random.RandomState(0).randn(20, 2)
+			computed = average_bandwith(data, num_runs=2, num_folds=2, seed=7, cache=cache)
+			self.assertEqual(1, len(cache.entries()))
+			self.assertEqual(2, len(runs))
+			cached = average_bandwith(data, num_runs=2, num_folds=2, seed=7, cache=cache)
+			self.assertEqual(computed, cached)
+			self.assertEqual(2, len(runs))
+			average_bandwith(data, num_runs=2, num_folds=2, cache=cache)
+			self.assertEqual(1, len(cache.entries()))
+			self.assertEqual(4, len(runs))
+		finally:
+			cross_validation.bandwidth_run = bandwidth_run
+			shutil.rmtree(path)
+
+	def test_cross_validated_likelihoods_cache(self):
+		"""check that a second call with the same arguments is read
+		from the cache without splitting the data again."""
+		path = tempfile.mkdtemp()
+		splits = []
+		def counted_folds(data, num_folds):
+			splits.append(num_folds)
+			return k_folds(data, num_folds)
+		cross_validation.k_folds = counted_folds
+		try:
+			cache = ResultCache(path)
+			data = np.random.RandomState(0).randn(20, 2)
+			computed = cross_validated_likelihoods(data, 2, 0.5, cache=cache)
+			self.assertEqual(1, len(cache.entries()))
+			self.assertEqual(1, len(splits))
+			cached = cross_validated_likelihoods(data, 2, 0.5, cache=cache)
+			self.assertEqual(computed, cached)
+			self.assertEqual(1, len(splits))
+		finally:
+			cross_validation.k_folds = k_folds
+			shutil.rmtree(path)
+
 
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file
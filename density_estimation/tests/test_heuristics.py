@@ -8,7 +8,11 @@ sys.path.insert(0,parentdir)
 import unittest
 import numpy as np
 from scipy.stats import gaussian_kde
+import heuristics
 from heuristics import mean_distance, mean_min_distance, scott, silverman
+from heuristics import sampled_mean_distance, sampled_mean_min_distance
+from heuristics import heuristics_report
+from scipy.spatial.distance import pdist, squareform
 
 """Define the required accuracy for the numerical tests,
 (measured in number of matching decimal places)."""
@@ -34,6 +38,41 @@ class TestDistances(unittest.TestCase):
 		mean_min_dist = mean_min_distance(points)
 		self.assertAlmostEqual(expected_mean_min_dist, mean_min_dist, ACCURACY)
 
+	def test_distances_match_brute_force(self):
+		"""check the blocked and tree-based distances against the
+		full distance matrix, with blocks smaller than the data."""
+		points = np.random.RandomState(0).randn(40, 3)
+		dists = squareform(pdist(points))
+		np.fill_diagonal(dists, np.inf)
+		block_size = heuristics.BLOCK_SIZE
+		heuristics.BLOCK_SIZE = 100
+		try:
+			mean_dist = mean_distance(points)
+		finally:
+			heuristics.BLOCK_SIZE = block_size
+		self.assertAlmostEqual(pdist(points).mean(), mean_dist, ACCURACY)
+		self.assertAlmostEqual(dists.min(axis=1).mean(), mean_min_distance(points), ACCURACY)
+
+	def test_sampled_mean_distance(self):
+		"""check that the sampled estimate reaches the requested
+		precision, covers the exact value and is fixed by the seed."""
+		points = np.random.RandomState(0).randn(300, 2)
+		estimate, (low, high) = sampled_mean_distance(points, num_samples=2000,
+				precision=0.02, seed=3)
+		self.assertTrue(high - low <= 0.04)
+		self.assertTrue(low - 0.02 <= mean_distance(points) <= high + 0.02)
+		self.assertEqual(estimate, sampled_mean_distance(points, num_samples=2000,
+				precision=0.02, seed=3)[0])
+
+	def test_sampled_mean_min_distance(self):
+		"""check that the sampled nearest neighbour estimate covers
+		the exact value."""
+		points = np.random.RandomState(0).randn(300, 2)
+		estimate, (low, high) = sampled_mean_min_distance(points, num_samples=500,
+				precision=0.005, seed=3)
+		self.assertTrue(high - low <= 0.01)
+		self.assertTrue(low - 0.005 <= mean_min_distance(points) <= high + 0.005)
+
 	def test_calculate_scott(self):
 		points = np.array([[0,0],
 						   [2,1],
@@ -57,5 +96,29 @@ class TestDistances(unittest.TestCase):
 		self.assertAlmostEqual(expected_factor, factor)
 
 
+class TestReport(unittest.TestCase):
+
+	def test_heuristics_report(self):
+		"""check that the report holds one row per dataset with the
+		same values as the individual heuristics, whether computed
+		serially or in a process pool."""
+		rng = np.random.RandomState(0)
+		datasets = {
+			'kenya_evi_2000_02': rng.randn(30, 2),
+			'benin_evi_2000_02': rng.randn(20, 3),
+		}
+		report = heuristics_report(datasets)
+		parallel = heuristics_report(datasets, num_workers=2)
+		self.assertEqual(['benin_evi_2000_02', 'kenya_evi_2000_02'], list(report.name))
+		for row, name in zip(report, report.name):
+			data = datasets[name]
+			self.assertEqual(data.shape[0], row.num_points)
+			self.assertAlmostEqual(scott(data), row.scott)
+			self.assertAlmostEqual(silverman(data), row.silverman)
+			self.assertAlmostEqual(mean_distance(data), row.mean_distance)
+			self.assertAlmostEqual(mean_min_distance(data), row.mean_min_distance)
+		np.testing.assert_array_almost_equal(report.mean_distance, parallel.mean_distance)
+
+
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file
@@ -2,13 +2,20 @@
 dataset.  It assumes that the dataset consists of a single grid of pixel
 values stored in a numpy array."""
 
+import json
+import hashlib
 import numpy as np
+from scipy import ndimage
+from multiprocessing import Pool
 
 
 """Missing data is indicated by the value -999 in the IDRISI
 Raster A.1 format."""
 MISSING = -999
 
+"""Default shape of the tiles used when filling rasters on disk."""
+TILE_SHAPE = (512, 512)
+
 def missing_coordinates(data):
     """Returns an np array of coordinates where data is missing."""
     missing_mask = (data == MISSING)
@@ -87,4 +94,371 @@ def replace_missing_values(data):
     for pixel_loc in zip(missing_coords[0], missing_coords[1]):
         neighbours = find_pixel_neighbourhood(pixel_loc, pixel_grid_dim)
         data[pixel_loc] = pixel_average(pixel_loc, neighbours, original_data)
-    return data
\ No newline at end of file
+    return data
+
+def shifted_slices(ndim, axis, shift):
+    """Returns a pair of index tuples (target, source) such that
+    array[target] lines up with array[source] moved by 'shift' pixels
+    along 'axis', i.e. each target pixel faces its neighbour at
+    offset -shift."""
+    target = [slice(None)] * ndim
+    source = [slice(None)] * ndim
+    if shift > 0:
+        target[axis], source[axis] = slice(shift, None), slice(None, -shift)
+    else:
+        target[axis], source[axis] = slice(None, shift), slice(-shift, None)
+    return tuple(target), tuple(source)
+
+def neighbour_sums(data, valid, axes=(0, 1), dtype=np.float64):
+    """Returns a tuple (sums, counts) holding, for every pixel, the sum
+    and number of its valid neighbours one step along each of 'axes'.
+    Neighbours are visited in the same order as find_pixel_neighbourhood
+    (previous then next along each axis) and summed in 'dtype'."""
+    values = np.where(valid, data, 0)
+    sums = np.zeros(data.shape, dtype=dtype)
+    counts = np.zeros(data.shape, dtype=np.uint8)
+    for axis in axes:
+        for shift in (1, -1):
+            target, source = shifted_slices(data.ndim, axis, shift)
+            sums[target] += values[source]
+            counts[target] += valid[source]
+    return sums, counts
+
+def fill_missing_values(data):
+    """Vectorized equivalent of replace_missing_values: every missing
+    pixel is replaced (in place) by the truncated average of its valid
+    4-neighbours, or by the land average if it has none. Neighbour sums
+    and counts are computed with shifted arrays over the whole grid,
+    and the land average is computed at most once."""
+    missing = (data == MISSING)
+    if not missing.any():
+        return data
+    sums, counts = neighbour_sums(data, ~missing)
+    sums, counts = sums[missing], counts[missing]
+    fills = np.empty(sums.shape)
+    has_neighbours = counts > 0
+    fills[has_neighbours] = np.trunc(sums[has_neighbours] / counts[has_neighbours])
+    if not has_neighbours.all():
+        fills[~has_neighbours] = land_average(data)
+    data[missing] = fills
+    return data
+
+def neighbour_offsets(ndim, axes=(0, 1)):
+    """Returns the list of unit offsets to the neighbours along 'axes',
+    in the same order as neighbour_sums."""
+    offsets = []
+    for axis in axes:
+        for step in (-1, 1):
+            offset = np.zeros(ndim, dtype=int)
+            offset[axis] = step
+            offsets.append(offset)
+    return offsets
+
+def frontier_sums(data, known, frontier, axes=(0, 1)):
+    """Returns a tuple (sums, counts) holding the sum and number of known
+    neighbours of each pixel in 'frontier' (a tuple of index arrays, as
+    returned by np.nonzero). Only the frontier pixels are touched."""
+    shape = np.array(data.shape)[:, np.newaxis]
+    coords = np.array(frontier)
+    sums = np.zeros(coords.shape[1])
+    counts = np.zeros(coords.shape[1], dtype=np.uint8)
+    for offset in neighbour_offsets(data.ndim, axes):
+        nbors = coords + offset[:, np.newaxis]
+        inside = np.all((nbors >= 0) & (nbors < shape), axis=0)
+        nbors = tuple(np.clip(nbors, 0, shape - 1))
+        valid = inside & known[nbors]
+        sums += np.where(valid, data[nbors], 0)
+        counts += valid
+    return sums, counts
+
+def next_frontier(known, filled, axes=(0, 1)):
+    """Returns the unknown pixels (as a tuple of index arrays) which
+    neighbour the pixels in 'filled'."""
+    shape = np.array(known.shape)[:, np.newaxis]
+    coords = np.array(filled)
+    candidates = []
+    for offset in neighbour_offsets(known.ndim, axes):
+        nbors = coords + offset[:, np.newaxis]
+        nbors = nbors[:, np.all((nbors >= 0) & (nbors < shape), axis=0)]
+        nbors = nbors[:, ~known[tuple(nbors)]]
+        candidates.append(np.ravel_multi_index(tuple(nbors), known.shape))
+    flat = np.unique(np.concatenate(candidates))
+    return np.unravel_index(flat, known.shape)
+
+def propagate_missing_values(data, max_iterations=None):
+    """Fills missing pixels (in place) by propagating inwards from the
+    edges of each gap. On every iteration the frontier, i.e. the missing
+    pixels with at least one known neighbour, is filled with the
+    truncated average of its known 4-neighbours (including pixels filled
+    on earlier iterations). Iteration stops when no frontier remains or
+    after 'max_iterations'; any pixels still missing (gaps with no data
+    at all, or beyond the iteration limit) get the land average."""
+    known = (data != MISSING)
+    if known.all():
+        return data
+    average = land_average(data)
+    counts = neighbour_sums(data, known)[1]
+    frontier = np.nonzero(~known & (counts > 0))
+    iteration = 0
+    while frontier[0].size:
+        if max_iterations is not None and iteration >= max_iterations:
+            break
+        sums, counts = frontier_sums(data, known, frontier)
+        data[frontier] = np.trunc(sums / counts)
+        known[frontier] = True
+        frontier = next_frontier(known, frontier)
+        iteration += 1
+    data[~known] = average
+    return data
+
+def nearest_fill(data):
+    """Fills missing pixels (in place) with the value of the nearest
+    valid pixel, found with a Euclidean distance transform in a single
+    pass. Returns a tuple (data, distances) where 'distances' holds the
+    fill distance of each pixel in pixels (zero for valid pixels), to
+    be used as a quality layer. If no pixel is valid the data is left
+    unchanged and every distance is infinite."""
+    missing = (data == MISSING)
+    if missing.all():
+        return data, np.full(data.shape, np.inf)
+    distances, indices = ndimage.distance_transform_edt(missing, return_indices=True)
+    data[missing] = data[tuple(indices[:, missing])]
+    return data, distances
+
+def stack_layers(layers):
+    """Takes a dict of equally shaped 2D layers keyed by date and returns
+    a tuple (dates, cube) where dates are the sorted keys and cube is
+    the (time, height, width) array of layers in that order."""
+    dates = sorted(layers.keys())
+    cube = np.array([layers[date] for date in dates])
+    return dates, cube
+
+def unstack_layers(dates, cube):
+    """Returns a dict mapping each date to its layer of the cube (the
+    inverse of stack_layers)."""
+    return dict(zip(dates, cube))
+
+def fill_missing_cube(cube, temporal=False):
+    """Fills every missing pixel of a (time, height, width) cube in place
+    with one vectorized pass. Each missing pixel gets the truncated
+    average of its valid spatial 4-neighbours, and also of the same pixel
+    in the previous and next layers if 'temporal' is True. Pixels with no
+    valid neighbours get the land average of their own layer. Without
+    'temporal' the result equals calling fill_missing_values on each
+    layer."""
+    missing = (cube == MISSING)
+    if not missing.any():
+        return cube
+    axes = (1, 2, 0) if temporal else (1, 2)
+    sums, counts = neighbour_sums(cube, ~missing, axes)
+    fills = np.trunc(sums[missing] / np.maximum(counts[missing], 1))
+    isolated = (counts[missing] == 0)
+    if isolated.any():
+        layer_averages = np.zeros(cube.shape[0])
+        layers = np.nonzero(missing)[0]
+        for layer in np.unique(layers[isolated]):
+            layer_averages[layer] = land_average(cube[layer])
+        fills[isolated] = layer_averages[layers[isolated]]
+    cube[missing] = fills
+    return cube
+
+def tile_windows(shape, tile_shape=TILE_SHAPE):
+    """Returns a list of (row, col, height, width) tiles which cover a
+    grid of the given shape."""
+    tiles = []
+    for row in range(0, shape[0], tile_shape[0]):
+        for col in range(0, shape[1], tile_shape[1]):
+            height = min(tile_shape[0], shape[0] - row)
+            width = min(tile_shape[1], shape[1] - col)
+            tiles.append((row, col, height, width))
+    return tiles
+
+def tiled_land_average(data, tile_shape=TILE_SHAPE):
+    """Returns the average value of all pixels on land, reading the
+    data one tile at a time. Integer data is summed exactly, so the
+    result equals land_average(data). Float data is summed in float64,
+    whereas land_average sums float32 data in float32, so for float32
+    data the two can differ by a few units in the last place."""
+    accumulator = np.int64 if np.issubdtype(data.dtype, np.integer) else np.float64
+    total, count = accumulator(0), 0
+    for row, col, height, width in tile_windows(data.shape, tile_shape):
+        tile = np.asarray(data[row:row + height, col:col + width])
+        land = tile[tile > MISSING]
+        total += land.sum(dtype=accumulator)
+        count += land.size
+    return float(total) / count if count else np.nan
+
+def fill_tile(args):
+    """Fills one tile of the memory-mapped output, given a tuple of
+    (input_path, output_path, tile, average). The tile is read with a
+    one pixel halo so its edge pixels see the same neighbours as in
+    fill_missing_values; pixels with no valid neighbours get the
+    precomputed land 'average'."""
+    input_path, output_path, tile, average = args
+    data = np.load(input_path, mmap_mode='r')
+    row, col, height, width = tile
+    top, left = max(row - 1, 0), max(col - 1, 0)
+    bottom = min(row + height + 1, data.shape[0])
+    right = min(col + width + 1, data.shape[1])
+    block = np.array(data[top:bottom, left:right])
+    interior = (slice(row - top, row - top + height),
+                slice(col - left, col - left + width))
+    missing = (block == MISSING)
+    if missing[interior].any():
+        sums, counts = neighbour_sums(block, ~missing)
+        sums, counts = sums[interior], counts[interior]
+        tile_data, tile_missing = block[interior], missing[interior]
+        fills = np.where(counts > 0, np.trunc(sums / np.maximum(counts, 1)), average)
+        tile_data[tile_missing] = fills[tile_missing]
+    output = np.load(output_path, mmap_mode='r+')
+    output[row:row + height, col:col + width] = block[interior]
+    output.flush()
+
+def fill_missing_tiled(input_path, output_path, tile_shape=TILE_SHAPE, num_workers=1):
+    """Applies fill_missing_values to the 2D array stored in the .npy
+    file 'input_path' and writes the result to the .npy file
+    'output_path', without loading either array into memory. Both
+    files are memory-mapped and processed tile by tile (optionally on
+    a pool of 'num_workers' processes), so peak memory is bounded by
+    the tile size. Returns the output as a read-only memory map.
+    Pixels filled from their neighbours match fill_missing_values
+    exactly; pixels given the land average match it exactly for
+    integer data and to within rounding for float data (see
+    tiled_land_average)."""
+    data = np.load(input_path, mmap_mode='r')
+    output = np.lib.format.open_memmap(output_path, mode='w+',
+                                       dtype=data.dtype, shape=data.shape)
+    del output
+    average = tiled_land_average(data, tile_shape)
+    args = [(input_path, output_path, tile, average)
+            for tile in tile_windows(data.shape, tile_shape)]
+    if num_workers <= 1:
+        for arg in args:
+            fill_tile(arg)
+    else:
+        pool = Pool(num_workers)
+        try:
+            pool.map(fill_tile, args)
+        finally:
+            pool.close()
+            pool.join()
+    return np.load(output_path, mmap_mode='r')
+
+def pack_mask(data):
+    """Returns the missing-data mask of data packed into a flat array
+    of bits (eight pixels per byte)."""
+    return np.packbits(data == MISSING, axis=None)
+
+def unpack_mask(bits, shape):
+    """Returns the boolean missing-data mask with the given shape
+    from its packed bits."""
+    size = int(np.prod(shape))
+    return np.unpackbits(bits, count=size).reshape(shape).astype(bool)
+
+def mask_hash(bits, shape):
+    """Returns a hex digest identifying a packed mask and its shape."""
+    digest = hashlib.sha1(str(tuple(shape)).encode('utf-8'))
+    digest.update(bits.tobytes())
+    return digest.hexdigest()
+
+def missing_summary(data):
+    """Returns a tuple (summary, bits) where bits is the packed mask of
+    data and summary is a dict with the 'shape', the missing 'ratio',
+    the 'bbox' of missing pixels (in the pixel_bbox format, or None if
+    nothing is missing) and the mask 'hash'. The data is scanned once."""
+    missing = (data == MISSING)
+    bits = np.packbits(missing, axis=None)
+    rows, cols = np.nonzero(missing.any(axis=1))[0], np.nonzero(missing.any(axis=0))[0]
+    bbox = None
+    if rows.size:
+        bbox = {
+            'x': int(cols[0]), 'y': int(rows[0]),
+            'width': int(cols[-1] - cols[0] + 1),
+            'height': int(rows[-1] - rows[0] + 1),
+        }
+    summary = {
+        'shape': list(data.shape),
+        'ratio': float(missing.sum()) / data.size,
+        'bbox': bbox,
+        'hash': mask_hash(bits, data.shape),
+    }
+    return summary, bits
+
+def missing_index(layers):
+    """Takes a dict of 2D layers and returns a tuple (index, masks).
+    index maps each layer name to its missing_summary, and masks maps
+    each mask hash to its packed bits, so layers with identical masks
+    (e.g. the same ocean mask) share a single stored mask."""
+    index, masks = {}, {}
+    for name in layers.keys():
+        summary, bits = missing_summary(layers[name])
+        index[name] = summary
+        masks.setdefault(summary['hash'], bits)
+    return index, masks
+
+def clean_layers(index):
+    """Returns the sorted names of layers with no missing data."""
+    return sorted(name for name in index.keys() if index[name]['ratio'] == 0)
+
+def layer_mask(index, masks, name):
+    """Returns the boolean missing-data mask of a layer in the index."""
+    summary = index[name]
+    return unpack_mask(masks[summary['hash']], summary['shape'])
+
+def save_missing_index(path, index, masks):
+    """Saves an index and its packed masks to a single .npz file."""
+    arrays = dict(masks)
+    arrays['index'] = np.array(json.dumps(index))
+    np.savez_compressed(path, **arrays)
+
+def load_missing_index(path):
+    """Returns the tuple (index, masks) saved by save_missing_index."""
+    with np.load(path) as archive:
+        index = json.loads(str(archive['index']))
+        masks = {key: archive[key] for key in archive.files if key != 'index'}
+    return index, masks
+
+def accumulator_dtype(dtype):
+    """Returns the dtype used to sum up to four neighbours of the given
+    dtype without overflow: int32 for integers of up to 16 bits, int64
+    for wider integers, and the dtype itself for floats."""
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        return np.dtype(np.int32) if dtype.itemsize <= 2 else np.dtype(np.int64)
+    return dtype
+
+def fill_missing_native(data, out=None):
+    """Fills missing pixels with the average of their valid 4-neighbours
+    (or the land average if they have none) working in the dtype of
+    data rather than float64. Float averages keep their fractional part,
+    and integer averages are rounded to the nearest integer instead of
+    truncated. The result is written into 'out', which must match the
+    shape and dtype of data; by default data is filled in place, so no
+    output copy is made. The neighbour sums still need a masked copy
+    of data and accumulator and count arrays of the same shape.
+    Returns out."""
+    if out is None:
+        out = data
+    elif out.shape != data.shape or out.dtype != data.dtype:
+        raise ValueError('out must have the shape and dtype of data')
+    elif out is not data:
+        np.copyto(out, data)
+    missing = (data == MISSING)
+    if not missing.any():
+        return out
+    sums, counts = neighbour_sums(data, ~missing, dtype=accumulator_dtype(data.dtype))
+    sums, counts = sums[missing], counts[missing]
+    has_neighbours = counts > 0
+    safe_counts = np.maximum(counts, 1).astype(sums.dtype)
+    if np.issubdtype(data.dtype, np.integer):
+        fills = (2 * sums + safe_counts) // (2 * safe_counts)
+    else:
+        fills = sums / safe_counts
+    if not has_neighbours.all():
+        land_data = data[data > MISSING]
+        average = land_data.mean(dtype=np.float64) if land_data.size else MISSING
+        if np.issubdtype(data.dtype, np.integer):
+            average = np.rint(average)
+        fills[~has_neighbours] = average
+    out[missing] = fills.astype(data.dtype)
+    return out
@@ -5,11 +5,18 @@ currentdir = os.path.dirname(currentdir_loc)
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
+import shutil
+import tempfile
 import unittest
 import numpy as np
 from missing_data import find_pixel_neighbourhood, pixel_average 
 from missing_data import missing_coordinates, replace_missing_values
-from missing_data import missing_ratio
+from missing_data import missing_ratio, fill_missing_values
+from missing_data import propagate_missing_values, neighbour_sums
+from missing_data import nearest_fill, fill_missing_cube, stack_layers
+from missing_data import fill_missing_tiled, missing_index, clean_layers
+from missing_data import layer_mask, save_missing_index, load_missing_index
+from missing_data import fill_missing_native
 
 class TestMissingCoordinates(unittest.TestCase):
 
@@ -214,6 +221,219 @@ class TestDataReplacement(unittest.TestCase):
 		data = replace_missing_values(missing_data)
 		np.testing.assert_array_equal(expected_data, data)
 
+	def test_fill_missing_values(self):
+		"""check that the vectorized fill matches the expected
+		neighbourhood averages."""
+		missing_data = np.array([[3,4,5],
+						         [4,-999,-999],
+						         [2,-999,5]])
+		expected_data = np.array([[3,4,5],
+					     		  [4,4,5],
+					     		  [2,3,5]])
+		data = fill_missing_values(missing_data)
+		np.testing.assert_array_equal(expected_data, data)
+
+	def test_fill_missing_values_matches_replacement(self):
+		"""check that the vectorized fill gives identical results to
+		replace_missing_values, including isolated missing pixels
+		that fall back to the land average."""
+		rng = np.random.RandomState(0)
+		for dtype in [int, float]:
+			data = (rng.randn(20, 30) * 100).astype(dtype)
+			data[rng.rand(20, 30) < 0.6] = -999
+			expected_data = replace_missing_values(np.copy(data))
+			filled = fill_missing_values(np.copy(data))
+			np.testing.assert_array_equal(expected_data, filled)
+
+
+class TestPropagation(unittest.TestCase):
+
+	def test_propagate_missing_values(self):
+		"""check that a gap is filled from its edges inwards, so
+		interior pixels take values propagated from the boundary."""
+		missing_data = np.array([[8,8,8,8],
+						         [8,-999,-999,-999],
+						         [8,-999,-999,-999],
+						         [8,-999,-999,-999]])
+		expected_data = 8 * np.ones((4, 4), dtype=int)
+		data = propagate_missing_values(missing_data)
+		np.testing.assert_array_equal(expected_data, data)
+
+	def test_propagate_first_iteration_matches_fill(self):
+		"""check that a single iteration fills the frontier exactly
+		as fill_missing_values does."""
+		rng = np.random.RandomState(0)
+		data = rng.randint(0, 100, size=(20, 30))
+		data[5:15, 8:20] = -999
+		expected_data = fill_missing_values(np.copy(data))
+		counts = neighbour_sums(data, data != -999)[1]
+		frontier = (data == -999) & (counts > 0)
+		filled = propagate_missing_values(np.copy(data), max_iterations=1)
+		np.testing.assert_array_equal(expected_data[frontier], filled[frontier])
+
+	def test_propagate_without_data_uses_land_average(self):
+		"""check that pixels unreachable within max_iterations take
+		the land average."""
+		missing_data = np.array([[2,-999,-999,-999,-999,4]])
+		expected_data = np.array([[2,2,3,3,4,4]])
+		data = propagate_missing_values(missing_data, max_iterations=1)
+		np.testing.assert_array_equal(expected_data, data)
+
+
+class TestNearestFill(unittest.TestCase):
+
+	def test_nearest_fill(self):
+		"""check that missing pixels take the value of the nearest
+		valid pixel and that fill distances are reported."""
+		missing_data = np.array([[1,-999,-999,-999,-999,7],
+						         [-999,-999,-999,-999,-999,-999]])
+		expected_data = np.array([[1,1,1,7,7,7],
+					     		  [1,1,1,7,7,7]])
+		expected_distances = np.array([[0,1,2,2,1,0],
+						  [1,np.sqrt(2),np.sqrt(5),np.sqrt(5),np.sqrt(2),1]])
+		data, distances = nearest_fill(missing_data)
+		np.testing.assert_array_equal(expected_data, data)
+		np.testing.assert_array_almost_equal(expected_distances, distances)
+
+
+class TestCubeFill(unittest.TestCase):
+
+	def test_fill_missing_cube_matches_layers(self):
+		"""check that filling a cube spatially matches filling each
+		layer separately, including the per-layer land average."""
+		rng = np.random.RandomState(0)
+		layers = {}
+		for month in range(1, 7):
+			layer = rng.randint(0, 100, size=(10, 12))
+			layer[rng.rand(10, 12) < 0.1 * month] = -999
+			layers['2000_%02d' % month] = layer
+		dates, cube = stack_layers(layers)
+		filled = fill_missing_cube(cube)
+		for date, layer in zip(dates, filled):
+			expected_layer = fill_missing_values(np.copy(layers[date]))
+			np.testing.assert_array_equal(expected_layer, layer)
+
+	def test_fill_missing_cube_temporal(self):
+		"""check that temporal neighbours are used when requested."""
+		cube = np.array([[[4,4],[4,4]],
+						 [[-999,-999],[-999,-999]],
+						 [[8,8],[8,8]]])
+		expected_cube = np.array([[[4,4],[4,4]],
+								  [[6,6],[6,6]],
+								  [[8,8],[8,8]]])
+		filled = fill_missing_cube(cube, temporal=True)
+		np.testing.assert_array_equal(expected_cube, filled)
+
+
+class TestTiledFill(unittest.TestCase):
+
+	def setUp(self):
+		"""writes a raster with gaps to a temporary .npy file."""
+		self.path = tempfile.mkdtemp()
+		self.input_path = os.path.join(self.path, 'input.npy')
+		self.output_path = os.path.join(self.path, 'output.npy')
+		rng = np.random.RandomState(0)
+		self.data = rng.randint(0, 1000, size=(37, 53)).astype(np.int16)
+		self.data[rng.rand(37, 53) < 0.5] = -999
+		np.save(self.input_path, self.data)
+
+	def test_fill_missing_tiled_matches_untiled(self):
+		"""check that tiles with a one pixel halo reproduce the
+		untiled fill exactly, serially and in a process pool. For
+		float32 data the land average fills match to within rounding."""
+		expected_data = fill_missing_values(np.copy(self.data))
+		for num_workers in [1, 2]:
+			filled = fill_missing_tiled(self.input_path, self.output_path,
+					tile_shape=(8, 10), num_workers=num_workers)
+			np.testing.assert_array_equal(expected_data, filled)
+			self.assertEqual(self.data.dtype, filled.dtype)
+		np.testing.assert_array_equal(self.data, np.load(self.input_path))
+		rng = np.random.RandomState(1)
+		data = (rng.rand(37, 53) * 1000).astype(np.float32)
+		data[rng.rand(37, 53) < 0.5] = -999
+		np.save(self.input_path, data)
+		missing = (data == -999)
+		isolated = missing & (neighbour_sums(data, ~missing)[1] == 0)
+		self.assertTrue(isolated.any())
+		expected_data = fill_missing_values(np.copy(data))
+		filled = fill_missing_tiled(self.input_path, self.output_path,
+				tile_shape=(8, 10))
+		self.assertEqual(np.float32, filled.dtype)
+		np.testing.assert_array_equal(expected_data[~isolated], filled[~isolated])
+		np.testing.assert_allclose(expected_data[isolated], filled[isolated], rtol=1e-6)
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+
+class TestMissingIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.ocean = np.array([[-999,3,4],
+							   [-999,-999,5]])
+		self.layers = {
+			'evi_2000_02': np.where(self.ocean == -999, -999, 1),
+			'evi_2000_03': np.where(self.ocean == -999, -999, 2),
+			'population': np.ones((2, 3), dtype=int),
+		}
+
+	def test_missing_index(self):
+		"""check the summary of each layer and that identical masks
+		are stored once."""
+		index, masks = missing_index(self.layers)
+		summary = index['evi_2000_02']
+		self.assertEqual(0.5, summary['ratio'])
+		self.assertEqual({'x': 0, 'y': 0, 'width': 2, 'height': 2}, summary['bbox'])
+		self.assertEqual(summary['hash'], index['evi_2000_03']['hash'])
+		self.assertEqual(2, len(masks))
+		self.assertEqual(['population'], clean_layers(index))
+		self.assertEqual(None, index['population']['bbox'])
+		np.testing.assert_array_equal(self.ocean == -999,
+				layer_mask(index, masks, 'evi_2000_02'))
+
+	def test_save_and_load_missing_index(self):
+		"""check that an index survives a round trip to disk."""
+		path = tempfile.mkdtemp()
+		try:
+			index, masks = missing_index(self.layers)
+			fname = os.path.join(path, 'index.npz')
+			save_missing_index(fname, index, masks)
+			loaded_index, loaded_masks = load_missing_index(fname)
+			self.assertEqual(index, loaded_index)
+			np.testing.assert_array_equal(self.ocean == -999,
+					layer_mask(loaded_index, loaded_masks, 'evi_2000_03'))
+		finally:
+			shutil.rmtree(path)
+
+
+class TestNativeFill(unittest.TestCase):
+
+	def test_fill_missing_native_float32(self):
+		"""check that float32 data keeps its dtype and fractional
+		averages, and is written into the supplied buffer."""
+		data = np.array([[1.5,2,-999],
+						 [4,-999,-999],
+						 [-999,-999,-999]], dtype=np.float32)
+		out = np.empty_like(data)
+		filled = fill_missing_native(data, out)
+		self.assertTrue(filled is out)
+		self.assertEqual(np.float32, out.dtype)
+		self.assertAlmostEqual(2, out[0, 2])
+		self.assertAlmostEqual(3, out[1, 1])
+		self.assertAlmostEqual(2.5, out[2, 2])
+		self.assertEqual(-999, data[1, 1])
+
+	def test_fill_missing_native_int16_in_place(self):
+		"""check that int16 data is filled in place with rounded
+		averages."""
+		data = np.array([[3,4,5],
+						 [4,-999,6],
+						 [2,8,5]], dtype=np.int16)
+		filled = fill_missing_native(data)
+		self.assertTrue(filled is data)
+		self.assertEqual(np.int16, data.dtype)
+		self.assertEqual(6, data[1, 1])
+
 		
 if __name__ == "__main__":
 	unittest.main()
@@ -15,7 +15,7 @@ import matplotlib.animation as animation
 from matplotlib import cm
 from termcolor import colored
 
-from missing_data import replace_missing_values, missing_ratio
+from missing_data import fill_missing_cube, stack_layers, unstack_layers
 import visualizer as viz
 
 ERROR   = "red"
@@ -64,15 +64,12 @@ def clip(data, vmin=0, vmax=100):
         data[date] = np.clip(data[date], vmin, vmax)
     return data
 
-def handle_missing_data(data):
+def handle_missing_data(data, temporal=False):
     ### Handle Missing Data
-    for date in data.keys():
-        missing_data_ratio = missing_ratio(data[date])        
-        #Replace missing data with average of neighbours
-        if missing_data_ratio:
-            data[date] = replace_missing_values(data[date])
-            
-    return data
+    #Replace missing data in every month at once with average of neighbours
+    dates, cube = stack_layers(data)
+    cube = fill_missing_cube(cube, temporal)
+    return unstack_layers(dates, cube)
 
 
 def build_evi_map(date, data, no_data, min_, max_, width, height):